@@ -1,14 +1,21 @@
 import os, sys
+import socket
+import threading
 import pandas as pd
 import numpy as np
 import pyarrow as pa
 import pyarrow.parquet as pq
+import pyarrow.csv as pcsv
+import pyarrow.compute as pac
 from datetime import datetime, timedelta
 import csv
 import gc
 import re
 import time
 import shutil
+import hashlib
+import json
+import inspect
 from joblib import Parallel, delayed
 
 BASE_PATH = "/kaggle/input/cert-r4-2/archive" 
@@ -44,31 +51,131 @@ def vectorized_is_weekend(dates):
     # Trả về True nếu là T7 (5) hoặc CN (6)
     return dates.dt.dayofweek.isin([5, 6])
 
+# --- INCREMENTAL MANIFEST ---
+# Mỗi stage/tuần có một bản ghi Manifest/{stage}/{key}.json: fingerprint đầu vào, phiên bản code,
+# cấu hình và fingerprint đầu ra. Chạy lại chỉ những tuần có thay đổi, và tiếp tục được sau khi crash.
+MANIFEST_DIR = "Manifest"
+
+def file_fingerprint(path, content=True):
+    # sha1 nội dung file; content=False chỉ dùng size + mtime (cho file csv nguồn hàng chục GB)
+    if not os.path.exists(path): return None
+    if not content:
+        st = os.stat(path)
+        return f"{st.st_size}-{st.st_mtime_ns}"
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 23), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def frame_fingerprint(df):
+    # Fingerprint ổn định của DataFrame (kể cả cột object chứa list như sharedpc)
+    return hashlib.sha1(df.to_json(orient='split', date_format='iso', default_handler=str).encode()).hexdigest()
+
+def code_version(stage):
+    # Hash mã nguồn các hàm của stage (STAGE_CODE được khai báo sau khi định nghĩa xong mọi hàm)
+    # Phần tử không phải hàm (bảng cấu hình như SESSION_FEATURE_SPEC) được hash theo repr
+    h = hashlib.sha1()
+    for func in STAGE_CODE[stage]:
+        if not callable(func):
+            h.update(repr(func).encode())
+            continue
+        try:
+            src = inspect.getsource(func)
+        except (OSError, TypeError):
+            src = func.__code__.co_code.hex() + repr(func.__code__.co_consts)
+        h.update(src.encode())
+    return h.hexdigest()
+
+def manifest_path(stage, key):
+    return os.path.join(MANIFEST_DIR, stage, f"{key}.json")
+
+def stage_is_current(stage, key, inputs, config):
+    # True nếu bản ghi cũ khớp đầu vào/code/cấu hình và các file đầu ra vẫn còn nguyên
+    path = manifest_path(stage, key)
+    if not os.path.exists(path): return False
+    with open(path, 'r') as f:
+        rec = json.load(f)
+    if rec['code'] != code_version(stage) or rec['inputs'] != inputs or rec['config'] != config:
+        return False
+    return all(file_fingerprint(p) == fp for p, fp in rec['outputs'].items())
+
+def write_stage_record(stage, key, inputs, config, outputs):
+    os.makedirs(os.path.join(MANIFEST_DIR, stage), exist_ok=True)
+    rec = {
+        'stage': stage, 'key': key,
+        'code': code_version(stage),
+        'inputs': inputs, 'config': config,
+        'outputs': {p: file_fingerprint(p) for p in outputs},
+        'finished': datetime.now().isoformat(),
+    }
+    # Ghi file tạm rồi đổi tên để bản ghi không bao giờ bị ghi dở (an toàn khi nhiều worker cùng ghi)
+    path = manifest_path(stage, key)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(rec, f, indent=1)
+    os.replace(path + '.tmp', path)
+
 # --- DATA PREPROCESSING ---
-def combine_by_timerange_pandas(dname = 'r4.2', chunk_size=300000):
-    all_columns = ['id', 'date', 'user', 'pc', 'type', 
-                   'activity', 'url', 'filename', 'content', 
-                   'to', 'cc', 'bcc', 'from', 'size', '#att']
-
-    pa_schema = pa.schema([
-        ('id', pa.string()),
-        ('date', pa.timestamp('ns')), # Timestamp nanosecond (mặc định của pandas)
-        ('user', pa.string()),
-        ('pc', pa.string()),
-        ('type', pa.string()),
-        ('activity', pa.string()),
-        ('url', pa.string()),
-        ('filename', pa.string()),
-        ('content', pa.string()),
-        ('to', pa.string()),
-        ('cc', pa.string()),
-        ('bcc', pa.string()),
-        ('from', pa.string()),
-        ('size', pa.string()),
-        ('#att', pa.string())
-    ])
-    
-    allacts = ['device','email','file', 'http','logon']
+# Cấu trúc chuẩn của các file DataByWeek/{week}.parquet
+DATA_COLUMNS = ['id', 'date', 'user', 'pc', 'type', 
+                'activity', 'url', 'filename', 'content', 
+                'to', 'cc', 'bcc', 'from', 'size', '#att']
+
+# Schema lúc đọc từ csv (mọi cột đều là chuỗi, trừ date)
+CSV_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('date', pa.timestamp('ns')), # Timestamp nanosecond (mặc định của pandas)
+    ('user', pa.string()),
+    ('pc', pa.string()),
+    ('type', pa.string()),
+    ('activity', pa.string()),
+    ('url', pa.string()),
+    ('filename', pa.string()),
+    ('content', pa.string()),
+    ('to', pa.string()),
+    ('cc', pa.string()),
+    ('bcc', pa.string()),
+    ('from', pa.string()),
+    ('size', pa.string()),
+    ('#att', pa.string())
+])
+
+# Schema lưu trữ: cột ít giá trị (user, pc, type, activity) dùng dictionary encoding,
+# size và #att lưu dạng số nguyên (pandas đọc ra category / số, không phải chuỗi)
+DATA_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('date', pa.timestamp('ns')),
+    ('user', pa.dictionary(pa.int32(), pa.string())),
+    ('pc', pa.dictionary(pa.int32(), pa.string())),
+    ('type', pa.dictionary(pa.int8(), pa.string())),
+    ('activity', pa.dictionary(pa.int8(), pa.string())),
+    ('url', pa.string()),
+    ('filename', pa.string()),
+    ('content', pa.string()),
+    ('to', pa.string()),
+    ('cc', pa.string()),
+    ('bcc', pa.string()),
+    ('from', pa.string()),
+    ('size', pa.int32()),
+    ('#att', pa.int16())
+])
+
+# Cấu hình ghi DataByWeek: codec nén và số dòng mỗi row group
+WEEK_COMPRESSION = 'zstd'
+WEEK_ROW_GROUP_SIZE = 300000
+
+# Thứ tự cột trong từng file csv nguồn (định dạng r4.2)
+ALL_ACTS = ['device','email','file', 'http','logon']
+ACT_COLUMNS = {
+    'device': ['id', 'date', 'user', 'pc', 'activity'],
+    'email': ['id', 'date', 'user', 'pc', 'to', 'cc', 'bcc', 'from', 'size', '#att', 'content'],
+    'file': ['id', 'date', 'user', 'pc', 'filename', 'content'],
+    'http': ['id', 'date', 'user', 'pc', 'url', 'content'],
+    'logon': ['id', 'date', 'user', 'pc', 'activity'],
+}
+
+def get_first_date():
+    # Mốc tuần 0: Chủ nhật gần nhất trước (hoặc bằng) ngày đầu tiên trong http.csv
     http_path = os.path.join(BASE_PATH, 'http.csv')
     with open(http_path, 'r') as f:
         next(f) # Bỏ qua header
@@ -76,7 +183,17 @@ def combine_by_timerange_pandas(dname = 'r4.2', chunk_size=300000):
     
     firstdate_dt = time_convert(firstline.split(',')[1],'t2dt')
     firstdate_dt = firstdate_dt - timedelta(int(firstdate_dt.strftime("%w")))
-    firstdate = time_convert(firstdate_dt, 'dt2date')
+    return time_convert(firstdate_dt, 'dt2date')
+
+def to_storage_table(table):
+    # Chuyển bảng chuỗi (CSV_SCHEMA) sang schema lưu trữ gọn (DATA_SCHEMA)
+    return table.select(DATA_COLUMNS).cast(DATA_SCHEMA)
+
+def combine_by_timerange_pandas(dname = 'r4.2', chunk_size=WEEK_ROW_GROUP_SIZE, compression=WEEK_COMPRESSION):
+    all_columns = DATA_COLUMNS
+    pa_schema = CSV_SCHEMA
+    allacts = ALL_ACTS
+    firstdate = get_first_date()
     
     act_handles = {act: open(os.path.join(BASE_PATH, act+'.csv'), 'r') for act in allacts}
     for h in act_handles.values(): next(h, None) # skip header
@@ -96,10 +213,7 @@ def combine_by_timerange_pandas(dname = 'r4.2', chunk_size=300000):
                 tmp = next(csv.reader([lines[act]]))
                 if time_convert(tmp[1], 't2wn', real_sd=firstdate) == week_index:
                     # Map columns based on r4.2 format
-                    if act == 'email': cols = ['id', 'date', 'user', 'pc', 'to', 'cc', 'bcc', 'from', 'size', '#att', 'content']
-                    elif act in ['logon', 'device']: cols = ['id', 'date', 'user', 'pc', 'activity']
-                    elif act in ['http']: cols = ['id', 'date', 'user', 'pc', 'url', 'content']
-                    elif act in ['file']: cols = ['id', 'date', 'user', 'pc', 'filename', 'content']
+                    cols = ACT_COLUMNS[act]
                     
                     entry = dict(zip(cols, tmp))
                     entry['type'] = act
@@ -125,10 +239,11 @@ def combine_by_timerange_pandas(dname = 'r4.2', chunk_size=300000):
                             print(f"Schema Error at week {week_index}: {e}")
                             # Fallback nếu schema lỗi (hiếm gặp)
                             table = pa.Table.from_pandas(df_chunk)
+                        table = to_storage_table(table)
                         
                         # Khởi tạo writer nếu chưa có (dùng schema của chunk đầu tiên)
                         if writer is None:
-                            writer = pq.ParquetWriter(week_file_name, table.schema, compression='snappy')
+                            writer = pq.ParquetWriter(week_file_name, table.schema, compression=compression)
                         
                         # Ghi chunk và xóa RAM
                         try: writer.write_table(table)
@@ -154,9 +269,10 @@ def combine_by_timerange_pandas(dname = 'r4.2', chunk_size=300000):
             try: table = pa.Table.from_pandas(df_chunk, schema=pa_schema)
             except:
                 table = pa.Table.from_pandas(df_chunk)
+            table = to_storage_table(table)
             
             if writer is None:
-                writer = pq.ParquetWriter(week_file_name, table.schema, compression='snappy')
+                writer = pq.ParquetWriter(week_file_name, table.schema, compression=compression)
             
             writer.write_table(table)
             del df_chunk, table
@@ -168,84 +284,245 @@ def combine_by_timerange_pandas(dname = 'r4.2', chunk_size=300000):
         print(f"Week {week_index} processed.")
         week_index += 1
 
+def get_source_ranges(act, split_bytes=1 << 30):
+    # Chia file nguồn thành các đoạn byte (cắt tại đầu dòng) để đọc song song
+    path = os.path.join(BASE_PATH, act + '.csv')
+    size = os.path.getsize(path)
+    n_parts = max(1, -(-size // split_bytes))
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for k in range(1, n_parts):
+            f.seek(k * size // n_parts)
+            f.readline() # Nhảy tới đầu dòng kế tiếp
+            pos = f.tell()
+            if bounds[-1] < pos < size: bounds.append(pos)
+    bounds.append(size)
+    return [(b0, b1 - b0) for b0, b1 in zip(bounds[:-1], bounds[1:])]
+
+def iter_act_week_batches(act, firstdate, block_size=1 << 26, offset=0, nbytes=None, use_threads=True):
+    """Đọc một file csv nguồn theo từng block (đa luồng) và trả về các đoạn (week, table) liên tiếp"""
+    cols = ACT_COLUMNS[act]
+    path = os.path.join(BASE_PATH, act + '.csv')
+    # Chỉ đoạn đầu tiên của file mới có header
+    read_opts = pcsv.ReadOptions(use_threads=use_threads, block_size=block_size, skip_rows=1 if offset == 0 else 0, column_names=cols)
+    conv_opts = pcsv.ConvertOptions(column_types={c: pa.string() for c in cols})
+    source = pa.OSFile(path)
+    stream = source if nbytes is None else source.get_stream(offset, nbytes)
+    reader = pcsv.open_csv(stream, read_options=read_opts, convert_options=conv_opts)
+    
+    first_ns = np.datetime64(firstdate, 'ns').astype(np.int64)
+    week_ns = 7 * 24 * 3600 * 10**9
+    for batch in reader:
+        n = batch.num_rows
+        if n == 0: continue
+        # Parse ngày và tính số tuần trên cả block (thay cho strptime từng dòng)
+        dates = pac.strptime(batch.column('date'), format='%m/%d/%Y %H:%M:%S', unit='ns')
+        weeks = (dates.cast(pa.int64()).to_numpy() - first_ns) // week_ns
+        
+        arrays = []
+        for c in DATA_COLUMNS:
+            if c == 'date': arrays.append(dates)
+            elif c == 'type': arrays.append(pa.array([act] * n, pa.string()))
+            elif c in cols: arrays.append(batch.column(c))
+            else: arrays.append(pa.nulls(n, pa.string()))
+        table = pa.Table.from_arrays(arrays, schema=CSV_SCHEMA)
+        
+        # File nguồn đã sort theo thời gian -> cắt block tại các điểm đổi tuần
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(weeks)) + 1, [n]))
+        for b0, b1 in zip(bounds[:-1], bounds[1:]):
+            yield int(weeks[b0]), table.slice(b0, b1 - b0)
+    source.close()
+
+def write_week_chunks(week_file_name, tables, chunk_size=WEEK_ROW_GROUP_SIZE, compression=WEEK_COMPRESSION):
+    # Ghi đúng từng khối chunk_size dòng như bản pandas (giữ nguyên cách chia row group)
+    writer = None
+    buffer = []
+    n_buffer = 0
+    for t in tables:
+        buffer.append(t)
+        n_buffer += t.num_rows
+        while n_buffer >= chunk_size:
+            table = pa.concat_tables(buffer).combine_chunks()
+            if writer is None:
+                writer = pq.ParquetWriter(week_file_name, DATA_SCHEMA, compression=compression)
+            writer.write_table(to_storage_table(table.slice(0, chunk_size)))
+            buffer = [table.slice(chunk_size)]
+            n_buffer -= chunk_size
+    
+    if n_buffer > 0:
+        table = pa.concat_tables(buffer).combine_chunks()
+        if writer is None:
+            writer = pq.ParquetWriter(week_file_name, DATA_SCHEMA, compression=compression)
+        writer.write_table(to_storage_table(table))
+    
+    # Đóng writer để hoàn tất file tuần
+    if writer: writer.close()
+
+def combine_by_timerange_arrow(dname = 'r4.2', chunk_size=WEEK_ROW_GROUP_SIZE, compression=WEEK_COMPRESSION, block_size=1 << 26):
+    # Cùng đầu ra với combine_by_timerange_pandas nhưng đọc csv theo block bằng pyarrow
+    firstdate = get_first_date()
+    
+    readers = {act: iter_act_week_batches(act, firstdate, block_size) for act in ALL_ACTS}
+    heads = {act: next(readers[act], None) for act in ALL_ACTS}
+    
+    def week_tables(week_index):
+        # Lấy lần lượt dữ liệu tuần week_index của từng nguồn (đúng thứ tự ALL_ACTS)
+        for act in ALL_ACTS:
+            while heads[act] is not None and heads[act][0] <= week_index:
+                if heads[act][0] < week_index:
+                    raise ValueError(f"{act}.csv is not sorted by date (week {heads[act][0]} after week {week_index})")
+                yield heads[act][1]
+                heads[act] = next(readers[act], None)
+
+    print(f"Start processing from date: {firstdate}")
+    
+    week_index = 0
+    while any(h is not None for h in heads.values()):
+        write_week_chunks(f"DataByWeek/{week_index}.parquet", week_tables(week_index), chunk_size, compression)
+        gc.collect()
+        print(f"Week {week_index} processed.")
+        week_index += 1
+
+def split_source_by_week(act, part, offset, nbytes, firstdate, block_size=1 << 26):
+    # Worker: tách một đoạn byte của file nguồn thành các fragment theo tuần
+    # DataByWeek/parts/{act}-{part}/{week}.parquet
+    out_dir = f"DataByWeek/parts/{act}-{part}"
+    os.makedirs(out_dir, exist_ok=True)
+    writer = None
+    cur_week = None
+    weeks = []
+    for week, table in iter_act_week_batches(act, firstdate, block_size, offset, nbytes, use_threads=False):
+        if week != cur_week:
+            if cur_week is not None and week < cur_week:
+                raise ValueError(f"{act}.csv is not sorted by date (week {week} after week {cur_week})")
+            if writer: writer.close()
+            writer = pq.ParquetWriter(f"{out_dir}/{week}.parquet", CSV_SCHEMA, compression='snappy')
+            cur_week = week
+            weeks.append(week)
+        writer.write_table(table)
+    if writer: writer.close()
+    return weeks
+
+def merge_week_fragments(week, part_dirs, chunk_size=WEEK_ROW_GROUP_SIZE, compression=WEEK_COMPRESSION):
+    # Gộp các fragment của một tuần theo thứ tự (act, part) -> DataByWeek/{week}.parquet
+    def week_tables():
+        for d in part_dirs:
+            frag = f"{d}/{week}.parquet"
+            if os.path.exists(frag):
+                for batch in pq.ParquetFile(frag).iter_batches(batch_size=chunk_size):
+                    yield pa.Table.from_batches([batch], schema=CSV_SCHEMA)
+    write_week_chunks(f"DataByWeek/{week}.parquet", week_tables(), chunk_size, compression)
+    for d in part_dirs:
+        frag = f"{d}/{week}.parquet"
+        if os.path.exists(frag): os.remove(frag)
+    print(f"Week {week} processed.")
+
+def combine_by_timerange_parallel(dname = 'r4.2', n_jobs=4, chunk_size=WEEK_ROW_GROUP_SIZE, compression=WEEK_COMPRESSION,
+                                  block_size=1 << 26, split_bytes=1 << 30):
+    # Bước 1 song song: mỗi worker xử lý một nguồn (hoặc một đoạn byte của nguồn lớn như http.csv),
+    # sau đó gộp các fragment theo tuần (cũng song song theo tuần)
+    firstdate = get_first_date()
+    print(f"Start processing from date: {firstdate}")
+    
+    tasks = [(act, part, offset, nbytes) for act in ALL_ACTS
+             for part, (offset, nbytes) in enumerate(get_source_ranges(act, split_bytes))]
+    # Xoá fragment sót lại từ lần chạy bị ngắt, tránh gộp dòng cũ vào file tuần mới
+    shutil.rmtree("DataByWeek/parts", ignore_errors=True)
+    results = Parallel(n_jobs=n_jobs)(delayed(split_source_by_week)(act, part, offset, nbytes, firstdate, block_size)
+                                      for (act, part, offset, nbytes) in tasks)
+    
+    # Thứ tự part_dirs (theo ALL_ACTS rồi theo part) quyết định thứ tự dòng trong file tuần
+    part_dirs = [f"DataByWeek/parts/{act}-{part}" for (act, part, _, _) in tasks]
+    all_weeks = sorted(set(w for r in results for w in r))
+    if all_weeks and all_weeks[0] < 0:
+        raise ValueError(f"Found activities before the first date {firstdate}")
+    Parallel(n_jobs=n_jobs)(delayed(merge_week_fragments)(w, part_dirs, chunk_size, compression) for w in all_weeks)
+    shutil.rmtree("DataByWeek/parts", ignore_errors=True)
+
 def process_user_pc(upd, roles): 
-    # Xác định PC nào thuộc về người dùng nào
-    upd['sharedpc'] = None
-    upd['npc'] = upd['pcs'].apply(lambda x: len(x))
+    # Xác định PC nào thuộc về người dùng nào (xử lý theo bảng cặp user-pc, không lặp từng user)
+    pairs = upd['pcs'].explode().dropna().reset_index()
+    pairs.columns = ['user', 'pc']
+    upd['npc'] = pairs.groupby('user').size().reindex(upd.index, fill_value=0)
+    pairs['npc'] = upd['npc'].reindex(pairs['user']).values
     
     # Trường hợp user chỉ dùng 1 PC duy nhất
-    upd.at[upd['npc']==1,'pc'] = upd[upd['npc']==1]['pcs'].apply(lambda x: x[0])
-    
-    # Xử lý các máy tính dùng chung (multi-user)
-    multiuser_pcs = np.concatenate(upd[upd['npc']>1]['pcs'].values).tolist()
-    set_multiuser_pc = list(set(multiuser_pcs))
-    count = {}
-    for pc in set_multiuser_pc:
-        count[pc] = multiuser_pcs.count(pc)
-        
-    for u in upd[upd['npc']>1].index:
-        sharedpc = upd.loc[u]['pcs']
-        count_u_pc = [count[pc] for pc in upd.loc[u]['pcs']]
-        # Chọn PC có ít người dùng nhất làm máy chính
-        the_pc = count_u_pc.index(min(count_u_pc))
-        upd.at[u,'pc'] = sharedpc[the_pc]
-        
-        # Nếu không phải ITAdmin, các máy còn lại trong danh sách được coi là sharedpc
-        if roles.loc[u] != 'ITAdmin':
-            sharedpc.remove(sharedpc[the_pc])
-            upd.at[u,'sharedpc']= sharedpc
+    upd['pc'] = pairs[pairs['npc'] == 1].set_index('user')['pc'].reindex(upd.index)
+    
+    # Xử lý các máy tính dùng chung (multi-user): đếm số user (có nhiều PC) dùng mỗi PC
+    multi = pairs[pairs['npc'] > 1].copy()
+    multi['count'] = multi.groupby('pc')['pc'].transform('size')
+    # Chọn PC có ít người dùng nhất làm máy chính (idxmin lấy PC đầu tiên nếu bằng nhau)
+    the_pc = multi.groupby('user', sort=False)['count'].idxmin()
+    upd.loc[the_pc.index, 'pc'] = multi.loc[the_pc.values, 'pc'].values
+    
+    # Nếu không phải ITAdmin, các máy còn lại trong danh sách được coi là sharedpc
+    others = multi.drop(index=the_pc.values)
+    others = others[roles.reindex(others['user']).values != 'ITAdmin']
+    shared = others.groupby('user', sort=False)['pc'].agg(list).to_dict()
+    upd['sharedpc'] = [shared.get(u) for u in upd.index]
     return upd
 
+def load_ldap_history(ldap_path, n_jobs=-1):
+    """Đọc mọi snapshot LDAP hàng tháng (song song) thành một bảng, rồi tính theo nhóm user:
+    thuộc tính lấy từ tháng đầu tiên xuất hiện, wstart = tháng đầu tiên,
+    wend = tháng đầu tiên vắng mặt sau đó (NaN nếu chưa nghỉ việc)."""
+    # Tên file là tháng (ví dụ: 2010-01.csv) -> sắp theo tên là đúng thứ tự thời gian
+    allfiles = sorted(f1 for f1 in os.listdir(ldap_path) if os.path.isfile(os.path.join(ldap_path, f1)))
+    months = [f1.split('.')[0] for f1 in allfiles]
+    frames = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(pd.read_csv)(os.path.join(ldap_path, f1), delimiter=',') for f1 in allfiles)
+    for (mi, frame) in enumerate(frames):
+        frame['_month'] = mi
+    ldap = pd.concat(frames, ignore_index=True)
+    # Cột thứ 2 là user_id; thuộc tính = cột 1 + các cột từ thứ 3 (giữ định dạng cũ)
+    cols = list(frames[0].columns[:-1])
+    uid = cols[1]
+    
+    # Thuộc tính + wstart: dòng đầu tiên của mỗi user (theo tháng, rồi theo thứ tự dòng trong file)
+    first = ldap.drop_duplicates(subset=uid, keep='first').set_index(uid)
+    df = first[[cols[0]] + cols[2:]].copy()
+    df['wstart'] = [months[mi] for mi in first['_month']]
+    
+    # wend: đếm số tháng liên tiếp có mặt tính từ tháng đầu tiên, tháng kế tiếp là tháng nghỉ việc
+    present = ldap[[uid, '_month']].drop_duplicates().sort_values([uid, '_month'])
+    first_mi = first['_month'].reindex(present[uid]).values
+    run = (present['_month'].values - present.groupby(uid).cumcount().values) == first_mi
+    run_len = pd.Series(run, index=present[uid].values).groupby(level=0).sum().reindex(df.index)
+    end_mi = first['_month'].values + run_len.values
+    df['wend'] = [months[mi] if mi < len(months) else np.nan for mi in end_mi]
+    df.index.name = None
+    return df
+
 def getuserlist(dname = 'r4.2', psycho = True):
     # Đọc dữ liệu nhân sự từ các file LDAP
-    allfiles = [os.path.join(LDAP_PATH, f1) for f1 in os.listdir(LDAP_PATH) if os.path.isfile(os.path.join(LDAP_PATH, f1))]
-    alluser = {}
-    alreadyFired = []
-    
-    for file in allfiles:
-        filename_only = os.path.basename(file) # Lấy tên file (ví dụ: 2010-01.csv)
-        af = (pd.read_csv(file, delimiter=',')).values
-        employeesThisMonth = []    
-        for i in range(len(af)):
-            employeesThisMonth.append(af[i][1])
-            if af[i][1] not in alluser:
-                # Dùng filename_only để split lấy ngày tháng
-                alluser[af[i][1]] = af[i][0:1].tolist() + af[i][2:].tolist() + [filename_only.split('.')[0] , np.nan]
-        firedEmployees = list(set(alluser.keys()) - set(alreadyFired) - set(employeesThisMonth))
-        alreadyFired = alreadyFired + firedEmployees
-        for e in firedEmployees:
-            alluser[e][-1] = filename_only.split('.')[0]
+    df = load_ldap_history(LDAP_PATH)
     
     # Thêm dữ liệu tâm lý học (O-C-E-A-N)
     psycho_path = os.path.join(BASE_PATH, "psychometric.csv")
     if psycho and os.path.isfile(psycho_path):
-        p_score = pd.read_csv(psycho_path, delimiter = ',').values
-        for id in range(len(p_score)):
-            alluser[p_score[id,1]] = alluser[p_score[id,1]] + list(p_score[id,2:])
-        df = pd.DataFrame.from_dict(alluser, orient='index')
+        p_score = pd.read_csv(psycho_path, delimiter = ',')
+        p_score = p_score.set_index(p_score.columns[1]).iloc[:, 1:]
+        p_score.columns = ['O', 'C', 'E', 'A', 'N']
+        df = df.join(p_score)
         df.columns = ['uname', 'email', 'role', 'b_unit', 'f_unit', 'dept', 'team', 'sup','wstart', 'wend', 'O', 'C', 'E', 'A', 'N']
     else:
-        df = pd.DataFrame.from_dict(alluser, orient='index')
         df.columns = ['uname', 'email', 'role', 'b_unit', 'f_unit', 'dept', 'team', 'sup', 'wstart', 'wend']
 
-    # Chuyển đổi tên người quản lý (supervisor) thành index
-    for i in df.index:
-        if type(df.loc[i]['sup']) == str:
-            sup_matches = df[df['uname'] == df.loc[i]['sup']].index
-            sup = sup_matches[0] if len(sup_matches) > 0 else None
-        else:
-            sup = None
-        df.at[i, 'sup'] = sup
+    # Chuyển đổi tên người quản lý (supervisor) thành index (user đầu tiên có uname trùng)
+    uname_to_index = pd.Series(df.index, index=df['uname'])
+    uname_to_index = uname_to_index[~uname_to_index.index.duplicated()]
+    sup = df['sup'].map(uname_to_index)
+    df['sup'] = sup.astype(object).where(sup.notna(), None)
         
-    # Xác định PC dựa trên log 2 tuần đầu tiên
-    w1 = pd.read_parquet("DataByWeek/0.parquet")
-    w2 = pd.read_parquet("DataByWeek/1.parquet")
+    # Xác định PC dựa trên log 2 tuần đầu tiên: các cặp (user, pc) xuất hiện ở cả hai tuần
+    w1 = pd.read_parquet("DataByWeek/0.parquet", columns=['user', 'pc']).astype(object).drop_duplicates()
+    w2 = pd.read_parquet("DataByWeek/1.parquet", columns=['user', 'pc']).astype(object).drop_duplicates()
+    common = w1.merge(w2, on=['user', 'pc']).dropna().sort_values(['user', 'pc'])
+    # sorted: thứ tự ổn định giữa các lần chạy
+    pcs = common.groupby('user', sort=False)['pc'].agg(list).to_dict()
     user_pc_dict = pd.DataFrame(index=df.index)
-    user_pc_dict['pcs'] = None  
-  
-    for u in df.index:
-        pc = list(set(w1[w1['user']==u]['pc']) & set(w2[w2['user']==u]['pc']))
-        user_pc_dict.at[u,'pcs'] = pc
+    user_pc_dict['pcs'] = [list(pcs.get(u, [])) for u in df.index]
         
     upd = process_user_pc(user_pc_dict, df['role'])
     df['pc'] = upd['pc']
@@ -269,7 +546,9 @@ def get_mal_userdata(data = 'r4.2', usersdf = None):
     usersdf['malscene'] = 0
     usersdf['mstart'] = None
     usersdf['mend'] = None
-    usersdf['malacts'] = None
+    # Danh sách hành động độc hại không lưu trong usersdf (tránh pickle cột lồng cho mọi worker)
+    # mà lưu thành bảng phẳng trên đĩa: answer_key_path(data)
+    key_parts = []
     
     for i in listmaluser.index:
         u_id = listmaluser['user'][i]
@@ -291,15 +570,116 @@ def get_mal_userdata(data = 'r4.2', usersdf = None):
             mal_users = np.array([x[3].strip('"') for x in malacts])
             mal_act_ids = np.array([x[1].strip('"') for x in malacts])
         
-            usersdf.at[u_id, 'malacts'] = mal_act_ids[mal_users == u_id]
+            act_ids = mal_act_ids[mal_users == u_id]
+            key_parts.append(pd.DataFrame({'user': u_id, 'act_id': act_ids,
+                                           'scenario': int(listmaluser['scenario'][i]),
+                                           'start': listmaluser['start'][i], 'end': listmaluser['end'][i]}))
         
         except FileNotFoundError:
             print(f"LỖI: Không tìm thấy file tại {mal_file_path}")
-            usersdf.at[u_id, 'malacts'] = []
-                    
+    
+    save_answer_key(key_parts, data)
     return usersdf
 
+# Bảng đáp án phẳng (user, act_id, scenario, start, end), lưu dạng Arrow IPC không nén để worker mmap
+ANSWER_KEY_SCHEMA = pa.schema([
+    ('user', pa.string()),
+    ('act_id', pa.string()),
+    ('scenario', pa.int16()),
+    ('start', pa.timestamp('ns')),
+    ('end', pa.timestamp('ns')),
+])
+
+def answer_key_path(data='r4.2'):
+    return os.path.join(CATALOG_DIR, f"answer_key_{data}.arrow")
+
+def save_answer_key(key_parts, data='r4.2'):
+    if key_parts:
+        table = pa.Table.from_pandas(pd.concat(key_parts, ignore_index=True), preserve_index=False).cast(ANSWER_KEY_SCHEMA)
+    else:
+        table = ANSWER_KEY_SCHEMA.empty_table()
+    # Ghi atomic như Manifest
+    os.makedirs(CATALOG_DIR, exist_ok=True)
+    path = answer_key_path(data)
+    with pa.OSFile(path + ".tmp", 'wb') as sink:
+        with pa.ipc.new_file(sink, ANSWER_KEY_SCHEMA) as writer:
+            writer.write_table(table)
+    os.replace(path + ".tmp", path)
+
+def open_answer_key(data='r4.2'):
+    # Mở read-only bằng memory map: các worker dùng chung page cache, không copy/pickle
+    return pa.ipc.open_file(pa.memory_map(answer_key_path(data), 'r')).read_all()
+
+# --- ID CATALOG ---
+# Bảng mã số nguyên toàn cục, dựng một lần ở bước 2 và lưu Catalog/ids_{data}.json:
+# user -> vị trí trong danh sách nhân sự, PC -> mã theo thứ tự chữ cái, thuộc tính user (role, dept...) -> mã.
+# Các bước sau chỉ làm việc trên mã số (tên miền HTTP đã có bảng tra riêng trong HTTP_DOMAIN_CACHE_DIR).
+CATALOG_DIR = "Catalog"
+
+def build_id_catalog(users, data='r4.2'):
+    # PC: PC được gán cho user + mọi PC xuất hiện trong DataByWeek (đọc dictionary của cột pc)
+    pcs = set(users['pc'].dropna()) | set(users['sharedpc'].dropna().explode().dropna())
+    for f in sorted(os.listdir("DataByWeek")):
+        if not f.endswith(".parquet"): continue
+        for chunk in pq.read_table(os.path.join("DataByWeek", f), columns=['pc'])['pc'].chunks:
+            pcs.update(chunk.dictionary.to_pylist() if pa.types.is_dictionary(chunk.type) else chunk.unique().to_pylist())
+    pcs.discard(None)
+    (_, uf_dict, list_uf) = get_u_features_dicts(users.copy(), data=data)
+    catalog = {'data': data, 'user': list(users.index), 'pc': sorted(pcs), 'list_uf': list_uf, 'uf': uf_dict}
+    
+    # Ghi atomic như Manifest
+    os.makedirs(CATALOG_DIR, exist_ok=True)
+    path = os.path.join(CATALOG_DIR, f"ids_{data}.json")
+    with open(path + ".tmp", 'w') as f:
+        json.dump(catalog, f)
+    os.replace(path + ".tmp", path)
+    return catalog
+
+def load_id_catalog(data='r4.2'):
+    with open(os.path.join(CATALOG_DIR, f"ids_{data}.json")) as f:
+        return json.load(f)
+
+def catalog_codes(catalog, kind):
+    # Từ điển giá trị -> mã số nguyên cho 'user' hoặc 'pc'
+    return {v: i for (i, v) in enumerate(catalog[kind])}
+
+def broadcast_frame(df, name, data='r4.2'):
+    """Ghi DataFrame (vd. bảng users) một lần ra file Arrow IPC, trả về đường dẫn để truyền cho worker
+    thay cho cả DataFrame (không pickle lại cho từng task)"""
+    os.makedirs(CATALOG_DIR, exist_ok=True)
+    path = os.path.join(CATALOG_DIR, f"{name}_{data}.arrow")
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    with pa.OSFile(path + ".tmp", 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(path + ".tmp", path)
+    return path
+
+# Đường dẫn file broadcast -> (mtime, DataFrame) đã chuyển sang pandas
+BROADCAST_FRAMES = {}
+
+def attach_frame(df_or_path):
+    """Worker mở file broadcast bằng memory map (dùng chung page cache) và chuyển sang pandas một lần,
+    giữ trong BROADCAST_FRAMES (chỉ đọc, không được sửa). Khi script được import, đệm sống suốt process;
+    chạy trực tiếp thì joblib gửi hàm theo giá trị nên đệm chỉ sống trong một task.
+    File đổi mtime (broadcast lại) thì đọc lại; DataFrame truyền trực tiếp thì giữ nguyên."""
+    if not isinstance(df_or_path, str): return df_or_path
+    key = os.path.getmtime(df_or_path)
+    if BROADCAST_FRAMES.get(df_or_path, (None,))[0] != key:
+        BROADCAST_FRAMES[df_or_path] = (key, pa.ipc.open_file(pa.memory_map(df_or_path, 'r')).read_all().to_pandas())
+    return BROADCAST_FRAMES[df_or_path][1]
+
 # --- FEATURE EXTRACTION (Focus: r4.2) ---
+def content_stats(col):
+    """Đặc trưng nội dung dùng chung cho email/file/http: (độ dài, số khoảng trắng, cờ rỗng).
+    Tính bằng kernel Arrow trên buffer chuỗi, không tạo object Python cho từng dòng. NaN coi như ''."""
+    arr = pac.fill_null(pa.array(col, type=pa.string(), from_pandas=True), '')
+    length = pac.utf8_length(arr).to_numpy()
+    n_spaces = pac.count_substring(arr, ' ').to_numpy()
+    # Rỗng sau khi strip: chuỗi rỗng hoặc chỉ toàn khoảng trắng
+    is_blank = (length == 0) | pac.utf8_is_space(arr).to_numpy(zero_copy_only=False)
+    return length, n_spaces, is_blank
+
 def vectorized_email_process(df_email):
     # Nếu DataFrame rỗng thì trả về rỗng ngay
     if len(df_email) == 0: return pd.DataFrame()
@@ -342,10 +722,9 @@ def vectorized_email_process(df_email):
     exbccmail = (n_ext_bcc > 0).astype(int) # Có email ngoại trong BCC
 
     # 4. Xử lý Content (Nội dung)
-    content = df_email['content'].fillna('').astype(str)
-    email_text_len = content.str.len()
+    (email_text_len, n_spaces, is_blank) = content_stats(df_email['content'])
     # Đếm số từ: đếm khoảng trắng + 1 (nếu không rỗng)
-    email_text_nwords = np.where(content.str.strip() == '', 0, content.str.count(' ') + 1)
+    email_text_nwords = np.where(is_blank, 0, n_spaces + 1)
 
     # 5. Trả về DataFrame kết quả (đúng thứ tự cột như logic cũ)
     # Các cột: n_des, #att, Xemail, n_exdes, n_bccdes, exbccmail, size, slen, nwords
@@ -361,29 +740,28 @@ def vectorized_email_process(df_email):
         'email_text_nwords': email_text_nwords
     }, index=df_email.index)
 
-def vectorized_http_process(df_http):
-    # Nếu DataFrame rỗng thì trả về rỗng ngay
-    if len(df_http) == 0: return pd.DataFrame()
-
-    # 1. Chuẩn bị dữ liệu (Handle NaNs)
-    url = df_http['url'].fillna('').astype(str)
-    content = df_http['content'].fillna('').astype(str)
-
-    # 2. Tính toán các đặc trưng cơ bản (Basic Features)
-    url_len = url.str.len()
-    
-    # url_depth: đếm số '/' trừ 2, chặn dưới tại 0
-    url_depth = np.maximum(0, url.str.count('/') - 2)
-    
-    content_len = content.str.len()
-    
-    # content_nwords: đếm khoảng trắng + 1
-    content_nwords = content.str.count(' ') + 1
-
-    # 3. Xử lý tên miền (Domain Extraction & Normalization)
-    # Lấy phần giữa // và / đầu tiên. Regex: //(.*?)/
-    domains = url.str.extract(r"//(.*?)/")[0].fillna('')
-    domains = domains.str.replace("www.", "", regex=False)
+# Danh sách website theo nhóm dùng để phân loại HTTP (http_type)
+HTTP_DOMAIN_LISTS = {
+    'cloud': ['dropbox.com', 'drive.google.com', 'mega.co.nz', 'account.live.com'],
+    'leak': ['wikileaks.org', 'freedom.press', 'theintercept.com'],
+    'social': ['facebook.com', 'twitter.com', 'plus.google.com', 'instagr.am', 'instagram.com',
+               'flickr.com', 'linkedin.com', 'reddit.com', 'about.com', 'youtube.com', 'pinterest.com',
+               'tumblr.com', 'quora.com', 'vine.co', 'match.com', 't.co'],
+    'job': ['indeed.com', 'monster.com', 'careerbuilder.com', 'simplyhired.com'],
+    'hack': ['webwatchernow.com', 'actionalert.com', 'relytec.com', 'refog.com', 'wellresearchedreviews.com',
+             'softactivity.com', 'spectorsoft.com', 'best-spy-soft.com'],
+}
+# Bảng tra host -> http_type lưu trên đĩa, dùng chung cho mọi tuần/worker/lần chạy
+HTTP_DOMAIN_CACHE_DIR = "Cache"
+# Tăng khi đổi luật trong classify_hosts để bỏ bảng tra cũ
+HTTP_DOMAIN_RULES_VERSION = 1
+# Bảng đã đọc vào bộ nhớ: (path, mtime) -> {host: (http_type, cờ aol)}
+HTTP_DOMAIN_TABLES = {}
+
+def classify_hosts(hosts):
+    """Chuẩn hóa và phân loại một danh sách host (mỗi host một lần).
+    Trả về (http_type theo tên miền, cờ aol.com cho luật Job theo URL)."""
+    domains = pd.Series(hosts, dtype=object).str.replace("www.", "", regex=False)
 
     # Logic rút gọn subdomain:
     # Điều kiện 1: len(dn) > 2 -> Tức là có từ 2 dấu chấm trở lên (ví dụ: a.b.c)
@@ -393,65 +771,130 @@ def vectorized_http_process(df_http):
     whitelist_pattern = r"google\.com|\.co\.uk|\.co\.nz|live\.com"
     cond_not_whitelist = ~domains.str.contains(whitelist_pattern, regex=True)
     
-    # Điều kiện kết hợp để rút gọn
-    mask_normalize = cond_parts & cond_not_whitelist
-    
     # Thực hiện rút gọn: Lấy 2 phần cuối cùng (tương đương ".".join(dn[-2:]))
-    # Regex: lấy tất cả ký tự không phải dấu chấm, theo sau bởi 1 dấu chấm, và nhóm ký tự cuối
     # Ví dụ: sub.example.com -> example.com
-    domains_normalized = np.where(
-        mask_normalize, 
+    domains_final = pd.Series(np.where(
+        cond_parts & cond_not_whitelist, 
         domains.str.extract(r'([^.]+\.[^.]+)$')[0].fillna(domains), 
         domains
-    )
-    
-    # Chuyển về Series để dùng các hàm str tiếp theo
-    domains_final = pd.Series(domains_normalized, index=df_http.index)
+    ))
+
+    # Các điều kiện theo thứ tự ưu tiên if-elif: Cloud (3) > Leak (5) > Social (2) > Job (4) > Hack (6) > Other (1)
+    c1 = domains_final.isin(HTTP_DOMAIN_LISTS['cloud'])
+    c2 = domains_final.isin(HTTP_DOMAIN_LISTS['leak'])
+    c3 = domains_final.isin(HTTP_DOMAIN_LISTS['social'])
+    # Job theo tên miền: (list) OR ('job' in d AND ('hunt' in d OR 'search' in d))
+    c4 = (domains_final.isin(HTTP_DOMAIN_LISTS['job'])) | \
+         (domains_final.str.contains('job', regex=False) & domains_final.str.contains(r'hunt|search', regex=True))
+    # Hack: (list) OR ('keylog' in d)
+    c5 = (domains_final.isin(HTTP_DOMAIN_LISTS['hack'])) | (domains_final.str.contains('keylog', regex=False))
+    
+    r = np.select([c1, c2, c3, c4, c5], [3, 5, 2, 4, 6], default=1)
+    is_aol = domains_final.str.contains('aol.com', regex=False).values
+    return r, is_aol
+
+def http_domain_cache_path():
+    # Tên file gắn với phiên bản luật phân loại: đổi danh sách thì tự dùng bảng mới. Không hash mã nguồn
+    # classify_hosts vì worker (notebook, hàm gửi theo giá trị) có thể không đọc được và ra tên file khác
+    ver = hashlib.sha1(repr((HTTP_DOMAIN_RULES_VERSION, HTTP_DOMAIN_LISTS)).encode()).hexdigest()[:12]
+    return os.path.join(HTTP_DOMAIN_CACHE_DIR, f"http_domains_{ver}.json")
+
+def http_domain_delta_paths(path):
+    # File host mới của từng worker (path không đuôi .json + .{pid}.jsonl)
+    prefix = os.path.basename(path)[:-len('.json')] + '.'
+    if not os.path.exists(HTTP_DOMAIN_CACHE_DIR): return []
+    return sorted(os.path.join(HTTP_DOMAIN_CACHE_DIR, f) for f in os.listdir(HTTP_DOMAIN_CACHE_DIR)
+                  if f.startswith(prefix) and f.endswith('.jsonl'))
+
+def read_http_domains(path, deltas):
+    # Bảng chung + các file host mới của worker (bỏ qua dòng ghi dở khi worker đang ghi hoặc bị dừng giữa chừng)
+    cache = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            cache = json.load(f)
+    for d in deltas:
+        with open(d) as f:
+            for line in f:
+                try:
+                    (h, v) = json.loads(line)
+                except ValueError:
+                    continue
+                cache[h] = v
+    return cache
+
+def load_http_domains(path):
+    # Bảng host -> (http_type, cờ aol), đọc một lần rồi giữ trong HTTP_DOMAIN_TABLES (bảng chung đổi mtime thì
+    # đọc lại). Gồm cả host worker đã ghi ở các task trước của bước 3 (chạy trực tiếp thì đệm chỉ sống một task).
+    # Host mới được thêm thẳng vào dict này nên các lô sau không phân loại lại
+    key = (path, os.path.getmtime(path) if os.path.exists(path) else None)
+    if key not in HTTP_DOMAIN_TABLES:
+        HTTP_DOMAIN_TABLES.clear()
+        HTTP_DOMAIN_TABLES[key] = read_http_domains(path, http_domain_delta_paths(path))
+    return HTTP_DOMAIN_TABLES[key]
+
+def lookup_http_domains(hosts):
+    """Tra http_type cho các host khác nhau qua bảng lưu trên đĩa; chỉ phân loại host chưa có.
+    Host mới được ghi nối vào file riêng của worker, merge_http_domain_cache gộp lại sau bước 3."""
+    path = http_domain_cache_path()
+    cache = load_http_domains(path)
+    hosts = list(hosts)
+    new_hosts = [h for h in hosts if h not in cache]
+    if new_hosts:
+        (r, is_aol) = classify_hosts(new_hosts)
+        new = dict(zip(new_hosts, zip(r.tolist(), is_aol.tolist())))
+        cache.update(new)
+        os.makedirs(HTTP_DOMAIN_CACHE_DIR, exist_ok=True)
+        with open(f"{path[:-len('.json')]}.{os.getpid()}.jsonl", 'a') as f:
+            f.writelines(json.dumps([h, v]) + '\n' for (h, v) in new.items())
+    vals = [cache[h] for h in hosts]
+    return (np.array([v[0] for v in vals], dtype=int).reshape(-1),
+            np.array([v[1] for v in vals], dtype=bool).reshape(-1))
+
+def merge_http_domain_cache():
+    """Gộp file host mới của mọi worker vào bảng chung (gọi một lần sau bước 3, khi không còn worker ghi)."""
+    path = http_domain_cache_path()
+    deltas = http_domain_delta_paths(path)
+    if not deltas: return
+    cache = read_http_domains(path, deltas)
+    # Ghi file tạm rồi đổi tên để bảng chung không bao giờ bị ghi dở
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(path + '.tmp', path)
+    for d in deltas: os.remove(d)
 
-    # 4. Phân loại Website (Categorization) - Dùng np.select
-    
-    # Định nghĩa danh sách
-    l_cloud = ['dropbox.com', 'drive.google.com', 'mega.co.nz', 'account.live.com']
-    l_leak = ['wikileaks.org', 'freedom.press', 'theintercept.com']
-    l_social = ['facebook.com', 'twitter.com', 'plus.google.com', 'instagr.am', 'instagram.com',
-                'flickr.com', 'linkedin.com', 'reddit.com', 'about.com', 'youtube.com', 'pinterest.com',
-                'tumblr.com', 'quora.com', 'vine.co', 'match.com', 't.co']
-    l_job = ['indeed.com', 'monster.com', 'careerbuilder.com', 'simplyhired.com']
-    l_hack = ['webwatchernow.com', 'actionalert.com', 'relytec.com', 'refog.com', 'wellresearchedreviews.com',
-              'softactivity.com', 'spectorsoft.com', 'best-spy-soft.com']
+def vectorized_http_process(df_http):
+    # Nếu DataFrame rỗng thì trả về rỗng ngay
+    if len(df_http) == 0: return pd.DataFrame()
 
-    # Tạo các điều kiện (Conditions) - Thứ tự quan trọng tương ứng if-elif
-    
-    # C1: Cloud (Nhóm 3)
-    c1 = domains_final.isin(l_cloud)
-    
-    # C2: Leak (Nhóm 5)
-    c2 = domains_final.isin(l_leak)
-    
-    # C3: Social (Nhóm 2)
-    c3 = domains_final.isin(l_social)
+    # 1. Chuẩn bị dữ liệu (Handle NaNs)
+    url = df_http['url'].fillna('').astype(str)
+
+    # 2. Tính toán các đặc trưng cơ bản (Basic Features)
+    url_len = url.str.len()
     
-    # C4: Job (Nhóm 4)
-    # Logic: (list) OR ('job' in d AND ('hunt' in d OR 'search' in d)) OR ('aol.com' in d AND ('recruit' in u OR 'job' in u))
-    has_job_kw = domains_final.str.contains('job', regex=False)
-    has_hunt_search = domains_final.str.contains(r'hunt|search', regex=True)
-    is_aol = domains_final.str.contains('aol.com', regex=False)
-    url_has_rec_job = url.str.contains(r'recruit|job', regex=True)
+    # url_depth: đếm số '/' trừ 2, chặn dưới tại 0
+    url_depth = np.maximum(0, url.str.count('/') - 2)
     
-    c4 = (domains_final.isin(l_job)) | \
-         (has_job_kw & has_hunt_search) | \
-         (is_aol & url_has_rec_job)
-         
-    # C5: Hack (Nhóm 6)
-    # Logic: (list) OR ('keylog' in d)
-    c5 = (domains_final.isin(l_hack)) | (domains_final.str.contains('keylog', regex=False))
+    (content_len, n_spaces, _) = content_stats(df_http['content'])
     
-    # Tổng hợp kết quả (Priority: Cloud > Leak > Social > Job > Hack > Other)
-    conditions = [c1, c2, c3, c4, c5]
-    choices = [3, 5, 2, 4, 6]
+    # content_nwords: đếm khoảng trắng + 1
+    content_nwords = n_spaces + 1
+
+    # 3. Xử lý tên miền (Domain Extraction)
+    # Chỉ tách host theo từng dòng (Regex: //(.*?)/), chuẩn hóa + phân loại chạy trên các host khác nhau
+    hosts = url.str.extract(r"//(.*?)/")[0].fillna('')
+    host_codes, host_uniques = pd.factorize(hosts)
+    (host_type, host_aol) = lookup_http_domains(host_uniques)
+
+    # 4. Phân loại Website (Categorization) - tra bảng theo mã host
+    r = host_type[host_codes]
     
-    # Default là 1 (Other)
-    r = np.select(conditions, choices, default=1)
+    # C4 (phần theo URL): aol.com và URL chứa 'recruit'/'job' -> Job (4),
+    # chỉ khi host chưa thuộc nhóm ưu tiên cao hơn (Cloud/Leak/Social/Job)
+    aol_rows = host_aol[host_codes] & np.isin(r, [1, 6])
+    if aol_rows.any():
+        url_has_rec_job = pd.Series(url.values[aol_rows]).str.contains(r'recruit|job', regex=True).values
+        r[np.flatnonzero(aol_rows)[url_has_rec_job]] = 4
 
     # 5. Trả về DataFrame kết quả
     return pd.DataFrame({
@@ -468,7 +911,6 @@ def vectorized_file_process(df_file):
 
     # 1. Chuẩn bị dữ liệu (Handle NaNs)
     filename = df_file['filename'].fillna('').astype(str)
-    content = df_file['content'].fillna('').astype(str)
 
     # 2. Trích xuất đuôi file (Extension)
     # Logic cũ: if "." in filename -> split(".")[-1] else "unknown"
@@ -489,9 +931,9 @@ def vectorized_file_process(df_file):
     file_depth = filename.str.count(r'\\')
 
     # 5. Đặc trưng nội dung (Content Features)
-    fsize = content.str.len()
+    (fsize, n_spaces, _) = content_stats(df_file['content'])
     # Đếm số từ: đếm khoảng trắng + 1
-    f_nwords = content.str.count(' ') + 1
+    f_nwords = n_spaces + 1
 
     # 6. Phân loại nhóm file (Category r)
     # Định nghĩa bảng ánh xạ (nhanh hơn if-elif)
@@ -516,29 +958,46 @@ def vectorized_file_process(df_file):
     }, index=df_file.index)
 
 def vectorized_from_pc(df_acts, users_df):
-    # map_own: User -> PC chính chủ
-    map_own = users_df['pc'].to_dict()
-    # map_sup: User -> PC của Sếp
-    s_sup_pc = users_df['sup'].map(map_own) # map_own đóng vai trò lookup PC
-    map_sup = s_sup_pc.to_dict()
-    shared_exploded = users_df[['sharedpc']].dropna().explode('sharedpc')
-    # Tạo set các tuple: {(user1, pcA), (user1, pcB), (user2, pcC)...}
-    shared_set = set(zip(shared_exploded.index, shared_exploded['sharedpc']))
-
-    # --- BƯỚC 2: CHUẨN BỊ DỮ LIỆU ---
-    act_users = df_acts['user']
-    act_pcs = df_acts['pc']
-    # Tìm PC mong đợi (Target PC) cho mỗi dòng
-    target_own_pcs = act_users.map(map_own)
-    target_sup_pcs = act_users.map(map_sup)
-    # --- BƯỚC 3: SO SÁNH VECTOR (LOGIC CHÍNH) ---
+    """Mã PC của từng hoạt động: 0 PC chính chủ, 1 PC dùng chung, 3 PC của sếp, 2 PC người khác.
+    User/PC được mã hóa số nguyên một lần (theo categories), mọi phép so sánh đều trên mảng số."""
+    # --- BƯỚC 1: MÃ HÓA USER / PC ---
+    # user/pc đọc từ DataByWeek là category -> dùng codes, chỉ tra cứu trên danh sách categories
+    act_users = df_acts['user'].astype('category')
+    act_pcs = df_acts['pc'].astype('category')
+    pc_cats = act_pcs.cat.categories
+    n_pc = len(pc_cats)
+    # Vị trí user trong users_df cho mỗi dòng (-1: user không có trong danh sách)
+    u_lut = np.append(users_df.index.get_indexer(act_users.cat.categories), -1)
+    u_pos = u_lut[act_users.cat.codes.values]
+    pc_code = act_pcs.cat.codes.values.astype(np.int64)
+    
+    # map_own: User -> mã PC chính chủ; map_sup: User -> mã PC của Sếp (-2: không có PC nào trong tuần khớp)
+    own_code = pc_cats.get_indexer(users_df['pc'].values)
+    s_sup_pc = users_df['sup'].map(users_df['pc'].to_dict()) # map_own đóng vai trò lookup PC
+    sup_code = pc_cats.get_indexer(s_sup_pc.values)
+    own_code = np.append(np.where(own_code >= 0, own_code, -2), -2)
+    sup_code = np.append(np.where(sup_code >= 0, sup_code, -2), -2)
+    
+    # Quan hệ PC dùng chung: mảng đã sắp xếp các khóa (vị trí user * n_pc + mã PC)
+    shared_exploded = users_df[['sharedpc']].dropna().explode('sharedpc').dropna()
+    sh_user = users_df.index.get_indexer(shared_exploded.index)
+    sh_pc = pc_cats.get_indexer(shared_exploded['sharedpc'].values)
+    valid = (sh_user >= 0) & (sh_pc >= 0)
+    shared_keys = np.unique(sh_user[valid].astype(np.int64) * n_pc + sh_pc[valid])
+
+    # --- BƯỚC 2: SO SÁNH VECTOR (LOGIC CHÍNH) ---
     # 1. Check Own PC (Code 0)
-    cond_own = (act_pcs == target_own_pcs)
+    cond_own = pc_code == own_code[u_pos]
     # 2. Check Shared PC (Code 1)
-    cond_shared = [(u, p) in shared_set for u, p in zip(act_users, act_pcs)]
+    known = (u_pos >= 0) & (pc_code >= 0)
+    row_keys = u_pos.astype(np.int64) * n_pc + pc_code
+    cond_shared = np.zeros(len(df_acts), dtype=bool)
+    if len(shared_keys) > 0:
+        pos = np.minimum(np.searchsorted(shared_keys, row_keys), len(shared_keys) - 1)
+        cond_shared = known & (shared_keys[pos] == row_keys)
     # 3. Check Supervisor PC (Code 3)
-    cond_sup = (act_pcs == target_sup_pcs)
-    # --- BƯỚC 4: TỔNG HỢP THEO THỨ TỰ ƯU TIÊN ---
+    cond_sup = pc_code == sup_code[u_pos]
+    # --- BƯỚC 3: TỔNG HỢP THEO THỨ TỰ ƯU TIÊN ---
     # Logic cũ: if Own -> 0, elif Shared -> 1, elif Sup -> 3, else -> 2
     conditions = [
         cond_own,       # Ưu tiên 1
@@ -551,21 +1010,106 @@ def vectorized_from_pc(df_acts, users_df):
     result = np.select(conditions, choices, default=2)
     return result
 
-def process_week_num(week, users, userlist='all', data='r4.2', chunk_size=300000):
-    # 1. Chuẩn bị dữ liệu đầu vào
-    file_path = f"DataByWeek/{week}.parquet"
-    if not os.path.exists(file_path): return        
-    
-    # Đọc dữ liệu (Load toàn bộ tuần vào RAM, nhanh hơn chunking nhỏ lẻ)
-    acts_week = pd.read_parquet(file_path)
-    
-    # Ép kiểu datetime và sort
+def map_categorical(col, mapping, default):
+    # Ánh xạ cột category: chỉ tra cứu trên danh sách categories rồi lấy theo codes
+    lut = np.array([mapping.get(c, default) for c in col.cat.categories] + [default])
+    return pd.Series(lut[col.cat.codes.values], index=col.index)
+
+def get_mal_act_index(answer_key):
+    # Index (user, id) của mọi hành động độc hại trong answer key, dùng chung cho mọi tuần
+    return pd.MultiIndex.from_arrays([answer_key['user'].to_numpy(zero_copy_only=False).astype(object),
+                                      answer_key['act_id'].to_numpy(zero_copy_only=False).astype(object)], names=['user', 'id'])
+
+# Các cột đặc trưng chi tiết của bảng số (khởi tạo bằng 0, mỗi loại hoạt động ghi vào phần của mình)
+NUM_FEATURE_COLS = [
+    'usb_dur', 
+    'file_type', 'file_len', 'file_nwords', 'disk', 'file_depth',
+    'http_type', 'url_len', 'url_depth', 'http_c_len', 'http_c_nwords',
+    'n_des', 'n_atts', 'Xemail', 'n_exdes', 'n_bccdes', 'exbccmail', 'email_size', 'email_text_slen', 'email_text_nwords'
+]
+
+# Schema gọn cho NumDataByWeek: mỗi cột dùng kiểu số nguyên nhỏ nhất đủ chứa giá trị
+# (cast kiểm tra tràn số -> báo lỗi thay vì ghi sai). Bước 4 đọc giữ nguyên các kiểu này.
+NUM_SCHEMA = pa.schema([
+    ('actid', pa.int32()),
+    ('pcid', pa.int32()),
+    ('time_stamp', pa.timestamp('ns')),
+    ('user', pa.int16()),
+    ('day', pa.int16()),
+    ('act', pa.int8()),
+    ('pc', pa.int8()),
+    ('time', pa.int8()),
+    ('usb_dur', pa.int32()),
+    ('file_type', pa.int8()),
+    ('file_len', pa.int32()),
+    ('file_nwords', pa.int32()),
+    ('disk', pa.int8()),
+    ('file_depth', pa.int16()),
+    ('http_type', pa.int8()),
+    ('url_len', pa.int32()),
+    ('url_depth', pa.int16()),
+    ('http_c_len', pa.int32()),
+    ('http_c_nwords', pa.int32()),
+    ('n_des', pa.int16()),
+    ('n_atts', pa.int16()),
+    ('Xemail', pa.int8()),
+    ('n_exdes', pa.int16()),
+    ('n_bccdes', pa.int16()),
+    ('exbccmail', pa.int8()),
+    ('email_size', pa.int32()),
+    ('email_text_slen', pa.int32()),
+    ('email_text_nwords', pa.int32()),
+    ('mal_act', pa.int8()),
+    ('insider', pa.int8()),
+])
+
+# Cột chung của mọi hoạt động (đọc cho cả tuần) và cột văn bản nặng theo từng loại hoạt động
+# (chỉ đọc cho các dòng đúng loại, bỏ ngay sau khi tính xong đặc trưng)
+BASE_COLUMNS = ['id', 'date', 'user', 'pc', 'type', 'activity']
+TEXT_COLUMNS = {
+    'email': ['to', 'cc', 'bcc', 'size', '#att', 'content'],
+    'file': ['filename', 'content'],
+    'http': ['url', 'content'],
+}
+
+def week_table_to_frame(table, index):
+    # Bảng Arrow -> pandas; cột content giữ nguyên buffer Arrow (không tạo str Python) cho content_stats
+    has_content = 'content' in table.column_names
+    df = (table.drop_columns(['content']) if has_content else table).to_pandas()
+    if has_content: df['content'] = pd.arrays.ArrowExtensionArray(table['content'])
+    df.index = index
+    return df
+
+def iter_week_frames(file_path, batch_rows):
+    # Đọc file tuần theo từng lô batch_rows dòng; index = vị trí dòng trong file (dùng làm actid)
+    # Trả về (bảng các cột chung, bảng Arrow của lô để lấy cột văn bản)
+    offset = 0
+    for batch in pq.ParquetFile(file_path).iter_batches(batch_size=batch_rows):
+        table = pa.Table.from_batches([batch])
+        yield week_table_to_frame(table.select(BASE_COLUMNS), pd.RangeIndex(offset, offset + len(table))), table
+        offset += batch.num_rows
+
+def load_week_text(text_source, act, mask):
+    """Cột văn bản của loại act cho các dòng mask (cùng thứ tự dòng). text_source là đường dẫn file tuần
+    (đọc đúng các cột cần, lọc type ngay khi đọc) hoặc bảng Arrow của lô đang xử lý."""
+    cols = TEXT_COLUMNS[act]
+    if isinstance(text_source, str):
+        table = pq.read_table(text_source, columns=cols, filters=[('type', '==', act)])
+    else:
+        table = text_source.select(cols).filter(pa.array(mask.values))
+    if table.num_rows != mask.sum():
+        raise ValueError(f"{act}: đọc được {table.num_rows} dòng văn bản, cần {mask.sum()}")
+    return week_table_to_frame(table, mask.index[mask.values])
+
+def num_features_batch(acts_week, text_source, users, user_dict, pc_dict, mal_index):
+    """Tính đặc trưng số cho một lô hoạt động. Mọi phép tính đều theo từng dòng nên lô có thể là
+    cả tuần hoặc một phần tuần. acts_week chỉ chứa BASE_COLUMNS, cột văn bản lấy từ text_source
+    theo từng loại. Trả về (bảng số chưa sắp theo thời gian, các dòng Connect/Disconnect)."""
     acts_week['date'] = pd.to_datetime(acts_week['date'])
-    acts_week.sort_values('date', inplace=True)
     
-    # Map User ID sang số nguyên (để tiết kiệm bộ nhớ cho model sau này)
-    user_dict = {idx: i for (i, idx) in enumerate(users.index)}
-    acts_week['user_int'] = acts_week['user'].map(user_dict).fillna(-1).astype(int)
+    # Map User ID / PC sang mã số nguyên của ID catalog (để tiết kiệm bộ nhớ cho model sau này)
+    acts_week['user_int'] = map_categorical(acts_week['user'], user_dict, -1)
+    acts_week['pcid'] = map_categorical(acts_week['pc'], pc_dict, -1)
     
     # ---------------------------------------------------------
     # 2. VECTORIZED FEATURE ENGINEERING (Xử lý hàng loạt)
@@ -597,7 +1141,7 @@ def process_week_num(week, users, userlist='all', data='r4.2', chunk_size=300000
     # Chỉ xử lý dòng nào là Logon/Logoff/Connect để tiết kiệm time
     mask_log = acts_week['activity'].isin(['Logon', 'Logoff', 'Connect', 'Disconnect'])
     # Tạo cột tạm type_clean
-    acts_week['type_clean'] = acts_week['type']
+    acts_week['type_clean'] = acts_week['type'].astype(object)
     acts_week.loc[mask_log, 'type_clean'] = acts_week.loc[mask_log, 'activity'].str.strip().str.lower()
     
     acts_week['act_num'] = acts_week['type_clean'].map(uacts_mapping).fillna(0).astype(int)
@@ -605,172 +1149,291 @@ def process_week_num(week, users, userlist='all', data='r4.2', chunk_size=300000
     # D. Trích xuất đặc trưng chi tiết (Sub-features)
     # ----------------------------------------------
     # Khởi tạo tất cả cột feature bằng 0
-    feature_cols = [
-        'usb_dur', 
-        'file_type', 'file_len', 'file_nwords', 'disk', 'file_depth',
-        'http_type', 'url_len', 'url_depth', 'http_c_len', 'http_c_nwords',
-        'n_des', 'n_atts', 'Xemail', 'n_exdes', 'n_bccdes', 'exbccmail', 'email_size', 'email_text_slen', 'email_text_nwords'
-    ]
-    for col in feature_cols:
+    for col in NUM_FEATURE_COLS:
         acts_week[col] = 0
 
     # 1. Xử lý FILE (Gọi hàm vectorized_file_process)
     mask_file = acts_week['type'] == 'file'
     if mask_file.any():
-        df_file_feats = vectorized_file_process(acts_week[mask_file])
+        df_file_feats = vectorized_file_process(load_week_text(text_source, 'file', mask_file))
         for c in df_file_feats.columns: acts_week.loc[mask_file, c] = df_file_feats[c]
 
     # 2. Xử lý EMAIL (Gọi hàm vectorized_email_process)
     mask_email = acts_week['type'] == 'email'
     if mask_email.any():
-        df_email_feats = vectorized_email_process(acts_week[mask_email])
+        df_email_feats = vectorized_email_process(load_week_text(text_source, 'email', mask_email))
         for c in df_email_feats.columns: acts_week.loc[mask_email, c] = df_email_feats[c]
 
     # 3. Xử lý HTTP (Gọi hàm vectorized_http_process)
     mask_http = acts_week['type'] == 'http'
     if mask_http.any():
-        df_http_feats = vectorized_http_process(acts_week[mask_http])
+        df_http_feats = vectorized_http_process(load_week_text(text_source, 'http', mask_http))
         for c in df_http_feats.columns: acts_week.loc[mask_http, c] = df_http_feats[c]
 
-    # 4. Xử lý USB Duration (Vectorized Logic - Group & Shift)
-    # Lọc ra các hành động Connect/Disconnect
+    # 4. USB Duration cần ghép cặp Connect/Disconnect trên cả tuần -> chỉ giữ lại các dòng liên quan
     usb_mask = acts_week['activity'].isin(['Connect', 'Disconnect'])
-    df_usb = acts_week.loc[usb_mask, ['user', 'pc', 'date', 'activity']].copy()
-    
-    # Sort để Connect và Disconnect nằm cạnh nhau
-    df_usb.sort_values(['user', 'pc', 'date'], inplace=True)
-    
-    # Shift (-1) để lấy thời gian của dòng tiếp theo đưa lên dòng hiện tại
-    df_usb['next_activity'] = df_usb.groupby(['user', 'pc'])['activity'].shift(-1)
-    df_usb['next_date'] = df_usb.groupby(['user', 'pc'])['date'].shift(-1)
-    
-    # Tính duration: Chỉ khi dòng này là Connect VÀ dòng sau là Disconnect
-    valid_pair = (df_usb['activity'] == 'Connect') & (df_usb['next_activity'] == 'Disconnect')
-    df_usb['duration'] = 0
-    df_usb.loc[valid_pair, 'duration'] = (df_usb.loc[valid_pair, 'next_date'] - df_usb.loc[valid_pair, 'date']).dt.total_seconds()
-    
-    # Map ngược lại vào bảng gốc (Mặc định là 0)
-    acts_week['usb_dur'] = 0
-    # Chỉ update những dòng Connect có cặp Disconnect hợp lệ
-    acts_week.loc[df_usb[valid_pair].index, 'usb_dur'] = df_usb.loc[valid_pair, 'duration']
+    df_usb = acts_week.loc[usb_mask, ['user', 'pc', 'date', 'activity']].astype({'user': object, 'pc': object, 'activity': object})
 
     # E. Gán nhãn Insider / Malicious Act
     # -----------------------------------
     # Logic: 
     # 1. Insider: Nếu user có malscene > 0 VÀ hành động nằm trong khoảng thời gian [mstart, mend]
-    # 2. Mal_Act: Nếu ID hành động nằm trong danh sách 'malacts' của user đó
+    # 2. Mal_Act: Nếu ID hành động nằm trong answer key của user đó
     
-    # Merge thông tin user (malscene, mstart, mend) vào bảng acts_week
-    user_info = users[['malscene', 'mstart', 'mend']].copy()
-    # Chuyển mstart/mend về datetime để so sánh
-    user_info['mstart'] = pd.to_datetime(user_info['mstart'])
-    user_info['mend'] = pd.to_datetime(user_info['mend'])
-    
-    # Merge trái (Left Join)
-    acts_week = acts_week.merge(user_info, left_on='user', right_index=True, how='left')
+    # Lấy thông tin user (malscene, mstart, mend) theo vị trí user_int, không merge (copy) cả bảng
+    u_pos = acts_week['user_int'].values
+    known = u_pos >= 0
+    malscene = np.where(known, users['malscene'].values[u_pos], 0)
+    mstart = pd.to_datetime(users['mstart']).values[u_pos]
+    mend = pd.to_datetime(users['mend']).values[u_pos]
     
     # Tính cột Insider (User có phải là insider tại thời điểm này không)
     # Điều kiện: Có malscene > 0 VÀ date >= mstart VÀ date <= mend
-    cond_time = (acts_week['date'] >= acts_week['mstart']) & (acts_week['date'] <= acts_week['mend'])
-    acts_week['insider'] = np.where((acts_week['malscene'] > 0) & cond_time, 
-                                    acts_week['malscene'], 
-                                    0).astype(int)
+    dates = acts_week['date'].values
+    cond_time = known & (dates >= mstart) & (dates <= mend)
+    acts_week['insider'] = np.where((malscene > 0) & cond_time, malscene, 0).astype(int)
 
     # Tính cột Mal_Act (Hành động cụ thể này có độc hại không)
-    # Tạo một Set chứa tất cả các cặp (User, ActID) độc hại để tra cứu O(1)
-    mal_pairs = set()
-    for u_idx, row in users.iterrows():
-        if isinstance(row['malacts'], (list, np.ndarray)):
-            for mid in row['malacts']:
-                mal_pairs.add((u_idx, str(mid))) # Lưu cặp (User, ActionID)
+    # Tra cứu vector các cặp (User, ActID) trong bảng answer key (dựng một lần cho mọi tuần)
+    mal_act = np.zeros(len(acts_week), dtype=int)
+    # Lọc trước theo ID (hash lookup), chỉ ghép cặp với user cho số ít dòng ứng viên
+    cand = acts_week['id'].isin(mal_index.get_level_values('id')).values
+    if cand.any():
+        pairs = pd.MultiIndex.from_arrays([np.asarray(acts_week['user'].values[cand], dtype=object),
+                                           acts_week['id'].values[cand]])
+        mal_act[cand] = pairs.isin(mal_index)
+    acts_week['mal_act'] = mal_act
+
+    # Chỉ giữ các cột số
+    cols_keep = ['pcid', 'date', 'user_int', 'day', 'act_num', 'pc_code', 'time'] + \
+                NUM_FEATURE_COLS + ['mal_act', 'insider']
+    return acts_week[cols_keep].copy(), df_usb
+
+# Ước tính RAM (byte) mỗi dòng khi xử lý một lô, ngoài dữ liệu thô: bảng pandas của num_features_batch
+# (~30 cột int64/datetime) và các cột tạm (type_clean, mask, kết quả từng loại hoạt động)
+NUM_BATCH_ROW_OVERHEAD = 512
+
+def num_batch_rows(file_path, memory_budget):
+    """Số dòng mỗi lô của bước 3 theo ngân sách RAM memory_budget (byte) của một worker: trừ phần
+    bảng số gọn của cả tuần (giữ đến cuối, x2 khi sắp xếp), phần còn lại chia cho RAM ước tính
+    của một dòng đang xử lý (dữ liệu thô chưa nén x2: Arrow + pandas, cộng NUM_BATCH_ROW_OVERHEAD)."""
+    md = pq.ParquetFile(file_path).metadata
+    if md.num_rows == 0: return 1
+    raw_row = sum(md.row_group(i).total_byte_size for i in range(md.num_row_groups)) / md.num_rows
+    num_row = sum(f.type.bit_width // 8 for f in NUM_SCHEMA)
+    avail = memory_budget - 2 * num_row * md.num_rows
+    if avail <= 0:
+        raise ValueError(f"{file_path}: memory_budget {memory_budget} too small for the {md.num_rows}-row numeric week")
+    return max(int(avail // (2 * raw_row + NUM_BATCH_ROW_OVERHEAD)), 1)
+
+def num_batch_table(df_num):
+    """Lô kết quả của num_features_batch -> bảng Arrow theo NUM_SCHEMA (actid = index), thu gọn ngay
+    sau khi tính (kiểm tra tràn số như trước); usb_dur được điền sau khi ghép cặp trên cả tuần."""
+    cols_source = ['pcid', 'date', 'user_int', 'day', 'act_num', 'pc_code', 'time'] + \
+                  NUM_FEATURE_COLS + ['mal_act', 'insider']
+    arrays = [pa.array(df_num.index.values.astype(np.int64)).cast(NUM_SCHEMA.field('actid').type)]
+    for (c, field) in zip(cols_source, list(NUM_SCHEMA)[1:]):
+        values = df_num[c].values
+        if c != 'date': values = values.astype(np.int64)
+        arrays.append(pa.array(values).cast(field.type))
+    return pa.Table.from_arrays(arrays, schema=NUM_SCHEMA)
+
+def usb_durations(df_usb):
+    # Ghép cặp USB (Vectorized Logic - Group & Shift); df_usb theo thứ tự thời gian của cả tuần
+    df_usb = df_usb.copy()
+    # Sort để Connect và Disconnect nằm cạnh nhau
+    df_usb.sort_values(['user', 'pc', 'date'], inplace=True)
     
-    # Hàm check nhanh
-    def check_mal_pair(row):
-        return 1 if (row['user'], str(row['id'])) in mal_pairs else 0
+    # Shift (-1) để lấy thời gian của dòng tiếp theo đưa lên dòng hiện tại
+    df_usb['next_activity'] = df_usb.groupby(['user', 'pc'])['activity'].shift(-1)
+    df_usb['next_date'] = df_usb.groupby(['user', 'pc'])['date'].shift(-1)
     
-    # Apply logic check (vẫn dùng apply dòng nhưng nhanh hơn vì check set O(1))
-    # Nếu dataset quá lớn, có thể dùng merge, nhưng apply check set vẫn khá nhanh
-    acts_week['mal_act'] = acts_week.apply(check_mal_pair, axis=1)
+    # Tính duration: Chỉ khi dòng này là Connect VÀ dòng sau là Disconnect
+    valid_pair = (df_usb['activity'] == 'Connect') & (df_usb['next_activity'] == 'Disconnect')
+    return (df_usb.loc[valid_pair, 'next_date'] - df_usb.loc[valid_pair, 'date']).dt.total_seconds()
+
+def process_week_num(week, users, userlist='all', data='r4.2', chunk_size=300000, incremental=False, mal_index=None, batch_rows=None, catalog=None, memory_budget=None):
+    """Chuyển log thô của tuần sang dạng số. batch_rows=None: đọc cả tuần một lần;
+    batch_rows=N: đọc theo lô N dòng, chỉ giữ bảng số gọn (NUM_SCHEMA) giữa các lô.
+    memory_budget (byte RAM mỗi worker): tự chọn batch_rows theo num_batch_rows khi không truyền batch_rows."""
+    # 1. Chuẩn bị dữ liệu đầu vào
+    file_path = f"DataByWeek/{week}.parquet"
+    if not os.path.exists(file_path): return        
+    save_path = f"NumDataByWeek/{week}_num.parquet"
+    users = attach_frame(users)
+    
+    if catalog is None: catalog = load_id_catalog(data)
+    
+    # Bỏ qua tuần nếu đầu vào, code và cấu hình không đổi so với lần chạy trước
+    m_inputs = {'data': file_fingerprint(file_path), 'users': frame_fingerprint(users),
+                'answer_key': file_fingerprint(answer_key_path(data)),
+                'catalog': hashlib.sha1(json.dumps(catalog, sort_keys=True).encode()).hexdigest()}
+    m_config = {'data': data}
+    if incremental and stage_is_current('num', week, m_inputs, m_config):
+        print(f"Week {week} (num) unchanged - skipped.")
+        return
+    
+    user_dict = catalog_codes(catalog, 'user')
+    pc_dict = catalog_codes(catalog, 'pc')
+    if mal_index is None: mal_index = get_mal_act_index(open_answer_key(data))
+    
+    # Đọc dữ liệu: cả tuần vào RAM (nhanh nhất) hoặc từng lô (giới hạn RAM)
+    if batch_rows is None and memory_budget is not None:
+        batch_rows = num_batch_rows(file_path, memory_budget)
+    # Cả tuần: chỉ đọc cột chung, cột văn bản được đọc riêng theo từng loại (lọc type khi đọc)
+    if batch_rows is None or batch_rows >= pq.ParquetFile(file_path).metadata.num_rows:
+        base = pq.read_table(file_path, columns=BASE_COLUMNS)
+        frames = [(week_table_to_frame(base, pd.RangeIndex(len(base))), file_path)]
+        del base
+    else:
+        frames = iter_week_frames(file_path, batch_rows)
+    # Mỗi lô được thu gọn về NUM_SCHEMA ngay sau khi tính, chỉ các bảng gọn này được giữ đến cuối tuần
+    num_parts, usb_parts = [], []
+    for (acts_batch, text_source) in frames:
+        df_num, df_usb = num_features_batch(acts_batch, text_source, users, user_dict, pc_dict, mal_index)
+        num_parts.append(num_batch_table(df_num))
+        usb_parts.append(df_usb)
+        del acts_batch, text_source, df_num
+    table = pa.concat_tables(num_parts)
+    df_usb = pd.concat(usb_parts) if len(usb_parts) > 1 else usb_parts[0]
+    del num_parts, usb_parts
+    
+    # Sắp xếp theo thời gian trên bảng gọn (quicksort như sort_values của pandas: giữ nguyên thứ tự cũ)
+    table = table.take(np.argsort(table['time_stamp'].to_numpy(), kind='quicksort'))
+    
+    # USB Duration: ghép cặp trên cả tuần (theo thứ tự thời gian), map ngược lại bảng số (Mặc định là 0)
+    actid = table['actid'].to_numpy()
+    df_usb = df_usb.loc[actid[np.isin(actid, df_usb.index.values)]]
+    usb_dur = usb_durations(df_usb)
+    # Chỉ update những dòng Connect có cặp Disconnect hợp lệ, usb_dur (giây) bị cắt phần lẻ
+    usb = np.zeros(len(table), dtype=np.int64)
+    usb[pd.Index(actid).get_indexer(usb_dur.index)] = usb_dur.values.astype(np.int64)
+    i_usb = NUM_SCHEMA.get_field_index('usb_dur')
+    table = table.set_column(i_usb, NUM_SCHEMA.field(i_usb), pa.array(usb).cast(NUM_SCHEMA.field(i_usb).type))
 
     # ---------------------------------------------------------
     # 3. LƯU FILE (FORMATTING & SAVING)
     # ---------------------------------------------------------
-    # Tạo các cột meta
-    acts_week['actid'] = acts_week.index
-    acts_week['pcid'] = acts_week['pc'] # Giữ nguyên PC string (PC-xxx) cho Session Logic
-    
-    # Đổi tên các cột đã tính toán về tên chuẩn
-    cols_source = ['actid', 'pcid', 'date', 'user_int', 'day', 'act_num', 'pc_code', 'time'] + \
-                  feature_cols + ['mal_act', 'insider']
-    
-    # Tên cột đích mong muốn trong file output
-    cols_target = ['actid', 'pcid', 'time_stamp', 'user', 'day', 'act', 'pc', 'time'] + \
-                  feature_cols + ['mal_act', 'insider']
-    
-    # Trích xuất dữ liệu chính xác
-    df_final = acts_week[cols_source].copy()
-    
-    # Đổi tên cột cho df_final
-    df_final.columns = cols_target
-    
-    # Ép kiểu int cho các cột số liệu (trừ pcid và time_stamp)
-    cols_to_int = ['user', 'day', 'act', 'pc', 'time'] + feature_cols + ['mal_act', 'insider']
-    df_final[cols_to_int] = df_final[cols_to_int].astype(int)
-    
-    # Lưu file Parquet (Ghi 1 lần, không cần chunking vì đã xử lý xong hết)
-    save_path = f"NumDataByWeek/{week}_num.parquet"
-    
-    # Dùng PyArrow để ghi
-    table = pa.Table.from_pandas(df_final)
-    pq.write_table(table, save_path, compression='snappy')
+    pq.write_table(table, save_path, compression='snappy', row_group_size=chunk_size)
+    write_stage_record('num', week, m_inputs, m_config, [save_path])
     
     # Dọn dẹp RAM
-    del acts_week, df_final, table, user_info
+    del df_usb, table
     gc.collect()
     
 # --- SESSION LOGIC ---
-def get_sessions(uw, first_sid=0):
-    sessions = {}
-    open_sessions = {}
-    sid = 0
-    
-    for i in uw.index:
-        current_pc = uw.loc[i]['pcid']
-        act_type = uw.loc[i]['act'] # 1: Logon, 2: Logoff
-        
-        if current_pc in open_sessions:
-            if act_type == 2: # Logoff
-                open_sessions[current_pc][2] = 1 # end_with logoff
-                open_sessions[current_pc][4] = uw.loc[i]['time_stamp']
-                open_sessions[current_pc][6].append(i)
-                sessions[sid] = [first_sid + sid] + open_sessions.pop(current_pc)
-                sid += 1
-            elif act_type == 1: # New Logon on same PC without logoff
-                open_sessions[current_pc][2] = 2
-                sessions[sid] = [first_sid + sid] + open_sessions.pop(current_pc)
-                sid += 1
-                open_sessions[current_pc] = [current_pc, 1, 0, uw.loc[i]['time_stamp'], uw.loc[i]['time_stamp'], 1, [i]]
-            else:
-                open_sessions[current_pc][4] = uw.loc[i]['time_stamp']
-                open_sessions[current_pc][6].append(i)
-        else:
-            start_status = 1 if act_type == 1 else 2
-            open_sessions[current_pc] = [current_pc, start_status, 0, uw.loc[i]['time_stamp'], uw.loc[i]['time_stamp'], 1, [i]]
-
-    for pc in open_sessions:
-        sessions[sid] = [first_sid + sid] + open_sessions[pc]
-        sid += 1
-
-    return sessions
-
-def get_u_features_dicts(ul, data = 'r4.2'):
-    """Tạo từ điển ánh xạ thông tin người dùng cho r4.2"""
+def get_sessions(w, first_sid=0):
+    """Gán session cho mọi hoạt động của tuần, xử lý vector theo nhóm (user, pc).
+    Cho kết quả giống hệt máy trạng thái cũ (duyệt từng dòng theo pc):
+      - Logon: đóng session đang mở của pc (end_with=2) và mở session mới (start_with=1)
+      - Logoff: đóng session đang mở (end_with=1); nếu pc chưa có session thì mở mới (start_with=2)
+      - Hoạt động khác: nối vào session đang mở, hoặc mở mới (start_with=2)
+    Trả về (bảng session theo thứ tự sessionid, mảng sessionid cho từng dòng của w)."""
+    n = len(w)
+    cols = ['sessionid', 'user', 'pcid', 'start_with', 'end_with', 'start_ts', 'end_ts', 'n_acts']
+    if n == 0:
+        return pd.DataFrame(columns=cols), np.zeros(0, dtype=np.int64)
+    
+    users_arr = w['user'].values.astype(np.int64)
+    pc_codes = pd.factorize(w['pcid'])[0]
+    acts = w['act'].values
+    ts = w['time_stamp'].values
+    idx = np.arange(n)
+    
+    # Sắp xếp theo (user, pc), giữ nguyên thứ tự thời gian bên trong mỗi nhóm
+    order = np.lexsort((idx, pc_codes, users_arr))
+    u_s, p_s, a_s = users_arr[order], pc_codes[order], acts[order]
+    first = np.ones(n, dtype=bool)
+    first[1:] = (u_s[1:] != u_s[:-1]) | (p_s[1:] != p_s[:-1])
+    is_logon = a_s == 1
+    is_logoff = a_s == 2
+    
+    # Trong một chuỗi logoff liên tiếp, các logoff luân phiên đóng / mở session:
+    # logoff đầu nhóm mở session (pc chưa mở), logoff sau một hoạt động khác thì đóng session
+    prev_logoff = np.zeros(n, dtype=bool)
+    prev_logoff[1:] = is_logoff[:-1] & ~first[1:]
+    run_head = np.maximum.accumulate(np.where(is_logoff & ~prev_logoff, idx, 0))
+    k_in_run = idx - run_head
+    logoff_open = is_logoff & ((k_in_run + np.where(first[run_head], 0, 1)) % 2 == 0)
+    logoff_close = is_logoff & ~logoff_open
+    
+    # Dòng mở session mới: đầu nhóm, Logon, logoff mở, hoặc ngay sau một logoff đã đóng session
+    after_close = np.zeros(n, dtype=bool)
+    after_close[1:] = logoff_close[:-1] & ~first[1:]
+    start = first | is_logon | logoff_open | after_close
+    
+    seg = np.cumsum(start) - 1
+    seg_first = np.flatnonzero(start)
+    seg_last = np.r_[seg_first[1:] - 1, n - 1]
+    n_seg = len(seg_first)
+    
+    closed_by_logoff = logoff_close[seg_last]
+    has_next = np.zeros(n_seg, dtype=bool)
+    has_next[:-1] = ~first[seg_first[1:]] # Session kế tiếp cùng (user, pc) -> bị đóng bởi Logon mới
+    end_with = np.where(closed_by_logoff, 1, np.where(has_next, 2, 0))
+    start_with = np.where(is_logon[seg_first], 1, 2)
+    
+    # Đánh số như vòng lặp cũ: trong mỗi user, session đã đóng theo thứ tự dòng gây đóng,
+    # sau đó các session còn mở theo thứ tự dòng mở session
+    row_first, row_last = order[seg_first], order[seg_last]
+    next_first = order[np.minimum(seg_last + 1, n - 1)]
+    close_pos = np.where(closed_by_logoff, row_last, np.where(has_next, next_first, row_first))
+    seg_user = u_s[seg_first]
+    rank = np.lexsort((close_pos, end_with == 0, seg_user))
+    seg_sid = np.empty(n_seg, dtype=np.int64)
+    seg_sid[rank] = first_sid + np.arange(n_seg)
+    
+    sid = np.empty(n, dtype=np.int64)
+    sid[order] = seg_sid[seg]
+    
+    sessions = pd.DataFrame({
+        'sessionid': seg_sid,
+        'user': seg_user,
+        'pcid': w['pcid'].values[row_first],
+        'start_with': start_with,
+        'end_with': end_with,
+        'start_ts': ts[row_first],
+        'end_ts': ts[row_last],
+        'n_acts': seg_last - seg_first + 1,
+    }, columns=cols).iloc[rank].reset_index(drop=True)
+    return sessions, sid
+
+def count_concurrent_sessions(users, starts, ends):
+    """Với mỗi session, đếm số session cùng user giao nhau về thời gian (kể cả chính nó):
+    (start_B < end_A) & (end_B > start_A). Dùng sắp xếp + tìm kiếm nhị phân, O(n log n) cho cả tuần."""
+    n = len(starts)
+    if n == 0: return np.zeros(0, dtype=np.int64)
+    # Đổi thời gian sang thứ hạng để ghép (user, thời gian) thành một khóa int64 duy nhất
+    times, inv = np.unique(np.concatenate((starts, ends)), return_inverse=True)
+    base = np.asarray(users, dtype=np.int64) * (len(times) + 1)
+    s_key = base + inv[:n]
+    e_key = base + inv[n:]
+    s_sorted = np.sort(s_key)
+    e_sorted = np.sort(e_key)
+    
+    # Số session cùng user có start < end_A, trừ đi số session có end <= start_A
+    n_start_before_end = np.searchsorted(s_sorted, e_key, 'left') - np.searchsorted(s_sorted, base, 'left')
+    n_end_before_start = np.searchsorted(e_sorted, s_key, 'right') - np.searchsorted(e_sorted, base, 'left')
+    counts = n_start_before_end - n_end_before_start
+    
+    # Session dài 0 (start == end) bị trừ nhầm các session dài 0 khác cùng thời điểm -> cộng lại
+    zero = s_key == e_key
+    if zero.any():
+        z_sorted = np.sort(s_key[zero])
+        counts[zero] += np.searchsorted(z_sorted, s_key[zero], 'right') - np.searchsorted(z_sorted, s_key[zero], 'left')
+    return counts
+
+def get_u_features_dicts(ul, data = 'r4.2', catalog = None):
+    """Tạo từ điển ánh xạ thông tin người dùng cho r4.2 (lấy sẵn từ ID catalog nếu có)"""
     ufdict = {}
     # r4.2 không có cột 'project'
     list_uf = ['role', 'b_unit', 'f_unit', 'dept', 'team']
     
     for f in list_uf:
         ul[f] = ul[f].astype(str)
+        if catalog is not None:
+            ufdict[f] = catalog['uf'][f]
+            continue
         tmp = list(set(ul[f]))
         tmp.sort()
         # Ánh xạ mỗi giá trị chữ sang một số nguyên
@@ -833,54 +1496,70 @@ def f_calc_subfeatures(ud, fname, filter_col, filter_vals, filter_names, sub_fea
         
     return (allf, allf_names)
 
-def f_calc(ud, mode = 'session', data = 'r4.2'):
-    # Khởi tạo các biến cơ bản
-    n_weekendact = (ud['time'] == 3).sum()
-    is_weekend = 1 if n_weekendact > 0 else 0
-    
-    # Đối với mode 'session', không đếm số lượng theo PC vì mỗi session thường gắn với 1 PC
-    all_countonlyf = {}
-    
+# Cấu hình đặc trưng hoạt động của session (dùng chung cho f_calc và f_calc_batch):
+# (tên nhóm, act, cột lọc, giá trị lọc, tên nhóm con, cột thống kê, cột chỉ đếm)
+# Đối với mode 'session', không đếm số lượng theo PC vì mỗi session thường gắn với 1 PC
+SESSION_FEATURE_SPEC = [
     # 1. Thống kê chung cho tất cả hành động trong session
-    [all_f, all_f_names] = f_calc_subfeatures(ud, 'allact', None, [], [], [], all_countonlyf)
-    
+    ('allact', None, None, [], [], [], {}),
     # 2. Thống kê hành động Logon (act == 1)
-    logon_countonlyf = {}
-    logon_statf = []
-    [all_logonf, all_logonf_names] = f_calc_subfeatures(ud[ud['act']==1], 'logon', None, [], [], logon_statf, logon_countonlyf)
-    
+    ('logon', 1, None, [], [], [], {}),
     # 3. Thống kê thiết bị USB (act == 3) - r4.2 chỉ có usb_dur
-    device_countonlyf = {}
-    device_statf = ['usb_dur']
-    [all_devicef, all_devicef_names] = f_calc_subfeatures(ud[ud['act']==3], 'usb', None, [], [], device_statf, device_countonlyf)
-    
+    ('usb', 3, None, [], [], ['usb_dur'], {}),
     # 4. Thống kê File (act == 7) - r4.2 lược bỏ to_usb, from_usb, file_act
     # r4.2: disk 0: unknown, 1: C, 2: R
-    file_countonlyf = {'disk':[0, 1, 2]}
-    (all_filef, all_filef_names) = f_calc_subfeatures(
-        ud[ud['act']==7], 'file', 'file_type', [1,2,3,4,5,6], 
-        ['otherf','compf','phof','docf','txtf','exef'], 
-        ['file_len', 'file_depth', 'file_nwords'], 
-        file_countonlyf
-    )
-    
+    ('file', 7, 'file_type', [1,2,3,4,5,6], 
+     ['otherf','compf','phof','docf','txtf','exef'], 
+     ['file_len', 'file_depth', 'file_nwords'], 
+     {'disk':[0, 1, 2]}),
     # 5. Thống kê Email (act == 6)
-    email_stats_f = ['n_des', 'n_atts', 'n_exdes', 'n_bccdes', 'email_size', 'email_text_slen', 'email_text_nwords']
-    mail_countonlyf = {'Xemail':[1], 'exbccmail':[1]}
     # r4.2 không có bộ lọc send/receive trong file email.csv thô
-    (all_emailf, all_emailf_names) = f_calc_subfeatures(ud[ud['act']==6], 'email', None, [], [], email_stats_f, mail_countonlyf)
-    
-    # 6. Thống kê HTTP (act == 5)
-    http_count_subf = {} # Lược bỏ pc và http_act (chỉ có ở r6)
-    (all_httpf, all_httpf_names) = f_calc_subfeatures(
-        ud[ud['act']==5], 'http', 'http_type', [1,2,3,4,5,6], 
-        ['otherf','socnetf','cloudf','jobf','leakf','hackf'], 
-        ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], 
-        http_count_subf
-    )
+    ('email', 6, None, [], [], 
+     ['n_des', 'n_atts', 'n_exdes', 'n_bccdes', 'email_size', 'email_text_slen', 'email_text_nwords'], 
+     {'Xemail':[1], 'exbccmail':[1]}),
+    # 6. Thống kê HTTP (act == 5) - Lược bỏ pc và http_act (chỉ có ở r6)
+    ('http', 5, 'http_type', [1,2,3,4,5,6], 
+     ['otherf','socnetf','cloudf','jobf','leakf','hackf'], 
+     ['url_len', 'url_depth', 'http_c_len', 'http_c_nwords'], 
+     {}),
+]
+
+# Mode 'day' / 'week' tính thêm mỗi nhóm trên từng khung giờ (time: 1 giờ hành chính, 2 ngoài giờ,
+# 3 cuối tuần, 4 đêm cuối tuần) và đếm theo loại PC (0 chính chủ, 1 dùng chung, 2 người khác, 3 của sếp)
+MODE_TIME_GROUPS = {
+    'session': [],
+    'day': [('workhour', [1, 3]), ('afterhour', [2, 4])],
+    'week': [('workhour', [1]), ('afterhour', [2]), ('weekend', [3, 4])],
+}
+MODE_PC_COUNTS = {'pc': [0, 1, 2, 3]}
+
+def mode_feature_groups(mode = 'session'):
+    """Các nhóm đặc trưng của một mode theo thứ tự cột: mỗi nhóm của SESSION_FEATURE_SPEC
+    trên toàn bộ hoạt động, rồi lần lượt trên từng khung giờ của mode (times = None: không lọc)"""
+    for (fname, act, filter_col, filter_vals, filter_names, stat_f, countonly_f) in SESSION_FEATURE_SPEC:
+        if mode != 'session':
+            countonly_f = {**countonly_f, **MODE_PC_COUNTS}
+        for (prefix, times) in [('', None)] + MODE_TIME_GROUPS[mode]:
+            yield (prefix + fname, act, times, filter_col, filter_vals, filter_names, stat_f, countonly_f)
+
+def f_calc(ud, mode = 'session', data = 'r4.2'):
+    # Khởi tạo các biến cơ bản
+    n_weekendact = (ud['time'] == 3).sum()
+    is_weekend = 1 if n_weekendact > 0 else 0
+    
+    # Tính lần lượt từng nhóm đặc trưng của mode (SESSION_FEATURE_SPEC + khung giờ)
+    features_tmp = []
+    fnames_tmp = []
+    for (fname, act, times, filter_col, filter_vals, filter_names, stat_f, countonly_f) in mode_feature_groups(mode):
+        uda = ud if act is None else ud[ud['act']==act]
+        if times is not None:
+            uda = uda[uda['time'].isin(times)]
+        (f, f_names) = f_calc_subfeatures(uda, fname, filter_col, filter_vals, filter_names, stat_f, countonly_f)
+        features_tmp += f
+        fnames_tmp += f_names
         
     # Xác định thông tin Insider (mal_act)
-    numActs = all_f[0]
+    numActs = features_tmp[0]
     mal_u = 0
     if (ud['mal_act']).sum() > 0:
         tmp = list(set(ud['insider']))
@@ -888,15 +1567,11 @@ def f_calc(ud, mode = 'session', data = 'r4.2'):
             tmp.remove(0.0)
         mal_u = tmp[0]
         
-    # Gộp tất cả vector đặc trưng của session
-    features_tmp = all_f + all_logonf + all_devicef + all_filef + all_emailf + all_httpf
-    fnames_tmp = all_f_names + all_logonf_names + all_devicef_names + all_filef_names + all_emailf_names + all_httpf_names
-    
     return [numActs, is_weekend, features_tmp, fnames_tmp, mal_u]
 
 def session_instance_calc(ud, sinfo, week, mode, data, uw, v, list_uf):
     # Lấy thông tin ngày thực hiện hành động đầu tiên trong session
-    d = ud.iloc[0]['day']
+    d = int(ud['day'].values[0])
     
     # Tính toán tỷ lệ thời gian hoạt động trong session
     # 1: Giờ hành chính, 2: Ngoài giờ, 3: Cuối tuần, 4: Đêm cuối tuần
@@ -930,7 +1605,7 @@ def session_instance_calc(ud, sinfo, week, mode, data, uw, v, list_uf):
     # Tạo vector instance hoàn chỉnh cho session
     # Kết hợp: Thông tin thời gian + Đặc trưng Session + Thông tin User + Đặc trưng Hoạt động + Nhãn Insider
     session_instance = [
-        starttime, endtime, v, sinfo[0], d, week, ud.iloc[0]['pc'], 
+        starttime, endtime, v, sinfo[0], d, week, int(ud['pc'].values[0]), 
         perworkhour, perafterhour, perweekend, perweekendafterhour, 
         n_days, s_dur, 
         sinfo[6], # n_concurrent_login (số lượng login đồng thời)
@@ -943,7 +1618,219 @@ def session_instance_calc(ud, sinfo, week, mode, data, uw, v, list_uf):
     
     return (session_instance, tmp[3]) # Trả về instance và danh sách tên cột (tmp[3])
 
-def to_csv(week, mode, data, ul, uf_dict, list_uf, chunk_size=300000):
+def f_stats_batch(w, spos, n_sess, mask, fn, stats_f, countonly_f = {}, get_stats = False):
+    """Phiên bản group-by của f_stats_calc: tính cho mọi session cùng lúc (spos: vị trí session của từng dòng)"""
+    f_count = np.bincount(spos[mask], minlength=n_sess)
+    has = f_count > 0
+    r = []
+    f_names = []
+    
+    for f in stats_f:
+        inp = w[f].values[mask]
+        f_mean = np.zeros(n_sess)
+        np.divide(np.bincount(spos[mask], weights=inp, minlength=n_sess), f_count, out=f_mean, where=has)
+        if get_stats:
+            g = pd.Series(inp, dtype=np.float64).groupby(spos[mask])
+            agg = [g.min(), g.max(), g.median(), None, g.std(ddof=0)]
+            agg = [f_mean if a is None else a.reindex(range(n_sess), fill_value=0.0).values for a in agg]
+            r += agg
+            f_names += [fn+'_min_'+f, fn+'_max_'+f, fn+'_med_'+f, fn+'_mean_'+f, fn+'_std_'+f]
+        else:
+            r += [f_mean]
+            f_names += [fn+'_mean_'+f]
+    
+    for f in countonly_f:
+        for v in countonly_f[f]:
+            r += [np.bincount(spos[mask & (w[f].values == v)], minlength=n_sess)]
+            f_names += [fn+'_n-'+f+str(v)]
+    
+    return (f_count, r, f_names)
+
+def f_calc_batch(w, spos, n_sess, get_stats = False, mode = 'session'):
+    """Tính toàn bộ đặc trưng hoạt động của f_calc cho mọi nhóm (session / user-ngày / user-tuần)
+    của tuần trong một lượt, tên và thứ tự cột giống hệt f_calc (theo mode_feature_groups)"""
+    act = w['act'].values
+    time_v = w['time'].values
+    all_rows = np.ones(len(w), dtype=bool)
+    features = []
+    fnames = []
+    for (fname, act_v, times, filter_col, filter_vals, filter_names, stat_f, countonly_f) in mode_feature_groups(mode):
+        mask = all_rows if act_v is None else (act == act_v)
+        if times is not None:
+            mask = mask & np.isin(time_v, times)
+        (n, stats, names) = f_stats_batch(w, spos, n_sess, mask, fname, stat_f, countonly_f, get_stats)
+        features += [n] + stats
+        fnames += ['n_' + fname] + names
+        for i in range(len(filter_vals)):
+            sub_mask = mask & (w[filter_col].values == filter_vals[i])
+            (n_sf, sf_stats, sf_names) = f_stats_batch(w, spos, n_sess, sub_mask, filter_names[i], stat_f, countonly_f, get_stats)
+            features += [n_sf] + sf_stats
+            fnames += [fname + '_n_' + filter_names[i]] + [fname + '_' + x for x in sf_names]
+    
+    # Nhãn insider của nhóm: khi có mal_act, lấy giá trị insider khác 0 nhỏ nhất (giống f_calc)
+    has_mal = np.bincount(spos, weights=w['mal_act'].values, minlength=n_sess) > 0
+    ins = w['insider'].values.astype(np.int64)
+    big = np.iinfo(np.int64).max
+    min_nz = np.full(n_sess, big)
+    np.minimum.at(min_nz, spos, np.where(ins != 0, ins, big))
+    mal_u = np.where(has_mal & (min_nz != big), min_nz, 0)
+    
+    return (features, fnames, mal_u)
+
+def user_feature_columns(uw, users, list_uf):
+    """Các cột thông tin user (list_uf, ITAdmin, O-C-E-A-N) cho từng dòng. Giống uw.loc[v, cols].tolist()
+    của session_instance_calc: mọi cột chung một dtype (float64 khi có cột số thực, vd OCEAN thiếu giá trị)."""
+    ucols = list_uf + ['ITAdmin', 'O', 'C', 'E', 'A', 'N']
+    u_vals = uw.loc[users, ucols]
+    dtype = np.result_type(*u_vals.dtypes)
+    return {c: u_vals[c].values.astype(dtype) for c in ucols}
+
+def session_instance_batch(w, sessions, spos, n_concurrent, week, uw, list_uf, get_stats = False):
+    """Phiên bản group-by của session_instance_calc: trả về DataFrame một dòng cho mỗi session,
+    cùng cột và thứ tự như các instance của to_csv"""
+    n_sess = len(sessions)
+    ts = w['time_stamp'].values
+    total_acts = np.bincount(spos, minlength=n_sess)
+    
+    # Dòng đầu tiên của mỗi session (w đã sort theo thời gian)
+    first_row = np.full(n_sess, len(w))
+    np.minimum.at(first_row, spos, np.arange(len(w)))
+    st_timestamp = np.full(n_sess, np.iinfo(np.int64).max)
+    end_timestamp = np.full(n_sess, np.iinfo(np.int64).min)
+    np.minimum.at(st_timestamp, spos, ts.view(np.int64))
+    np.maximum.at(end_timestamp, spos, ts.view(np.int64))
+    st_dt = pd.DatetimeIndex(st_timestamp.view('datetime64[ns]'))
+    end_dt = pd.DatetimeIndex(end_timestamp.view('datetime64[ns]'))
+    
+    # Số ngày khác nhau trong session
+    day = w['day'].values.astype(np.int64)
+    day_base = day.max() + 1 if len(day) > 0 else 1
+    day_keys = np.unique(spos.astype(np.int64) * day_base + day)
+    n_days = np.bincount(day_keys // day_base, minlength=n_sess)
+    
+    out = {
+        'starttime': st_timestamp / 1e9,
+        'endtime': end_timestamp / 1e9,
+        'user': sessions['user'].values.astype(np.int64),
+        'sessionid': sessions['sessionid'].values.astype(np.int64),
+        'day': w['day'].values[first_row].astype(np.int64),
+        'week': np.full(n_sess, week),
+        'pc': w['pc'].values[first_row].astype(np.int64),
+    }
+    # 1: Giờ hành chính, 2: Ngoài giờ, 3: Cuối tuần, 4: Đêm cuối tuần
+    for (col, t) in [('isworkhour', 1), ('isafterhour', 2), ('isweekend', 3), ('isweekendafterhour', 4)]:
+        out[col] = np.bincount(spos, weights=(w['time'].values == t), minlength=n_sess) / total_acts
+    out['n_days'] = n_days
+    out['duration'] = (end_timestamp - st_timestamp) / 6e10
+    out['n_concurrent_sessions'] = np.asarray(n_concurrent, dtype=np.int64)
+    out['start_with'] = sessions['start_with'].values.astype(np.int64)
+    out['end_with'] = sessions['end_with'].values.astype(np.int64)
+    out['ses_start'] = st_dt.hour + st_dt.minute / 60
+    out['ses_end'] = end_dt.hour + end_dt.minute / 60
+    
+    out.update(user_feature_columns(uw, out['user'], list_uf))
+    
+    (features, fnames, mal_u) = f_calc_batch(w, spos, n_sess, get_stats)
+    for (c, vals) in zip(fnames, features):
+        out[c] = vals
+    out['insider'] = mal_u
+    return pd.DataFrame(out)
+
+def period_instance_batch(w, mode, week, uw, list_uf, get_stats = False):
+    """Đặc trưng theo user-ngày (mode 'day') hoặc user-tuần (mode 'week'): một dòng cho mỗi nhóm,
+    tính bằng group-by trên cùng bảng w của tuần như session (sắp theo user, rồi theo ngày)"""
+    user = w['user'].values.astype(np.int64)
+    day = w['day'].values.astype(np.int64)
+    if mode == 'day':
+        day_base = day.max() + 1 if len(day) > 0 else 1
+        keys = user * day_base + day
+    else:
+        keys = user
+    (g_keys, gpos) = np.unique(keys, return_inverse=True)
+    n_g = len(g_keys)
+    
+    first_row = np.full(n_g, len(w))
+    np.minimum.at(first_row, gpos, np.arange(len(w)))
+    ts = w['time_stamp'].values.view(np.int64)
+    st_timestamp = np.full(n_g, np.iinfo(np.int64).max)
+    end_timestamp = np.full(n_g, np.iinfo(np.int64).min)
+    np.minimum.at(st_timestamp, gpos, ts)
+    np.maximum.at(end_timestamp, gpos, ts)
+    
+    out = {
+        'starttime': st_timestamp / 1e9,
+        'endtime': end_timestamp / 1e9,
+        'user': user[first_row],
+    }
+    if mode == 'day':
+        out['day'] = day[first_row]
+    out['week'] = np.full(n_g, week)
+    if mode == 'day':
+        # Ngày có hoạt động cuối tuần (time 3, 4) là ngày cuối tuần
+        is_weekend = np.bincount(gpos, weights=(w['time'].values >= 3), minlength=n_g) > 0
+        out['isweekday'] = (~is_weekend).astype(np.int64)
+        out['isweekend'] = is_weekend.astype(np.int64)
+    
+    out.update(user_feature_columns(uw, out['user'], list_uf))
+    
+    (features, fnames, mal_u) = f_calc_batch(w, gpos, n_g, get_stats, mode)
+    for (c, vals) in zip(fnames, features):
+        out[c] = vals
+    out['insider'] = mal_u
+    return pd.DataFrame(out)
+
+# Kết quả bước 4 là dataset Parquet chia partition kiểu Hive theo tuần, mỗi mode một dataset:
+# ExtractedData/session_r4.2/week=N/part-0.parquet (cột week nằm trên đường dẫn, không lưu trong file)
+SESSION_PARTITION_COL = 'week'
+# Số dòng mỗi row group: nhỏ để reader lọc theo user (đã sắp xếp) bỏ qua được phần lớn file
+SESSION_ROW_GROUP_SIZE = 20000
+# Thứ tự sắp xếp các dòng trong partition của từng mode
+MODE_SORT_COLS = {'session': ['user', 'sessionid'], 'day': ['user', 'day'], 'week': ['user']}
+
+def session_partition_path(mode, data, week):
+    return f"ExtractedData/{mode}_{data}/{SESSION_PARTITION_COL}={week}/part-0.parquet"
+
+def open_session_writer(output_file, schema, n_users=None, mode='session', compression='snappy'):
+    """Mở writer cho một partition: thống kê cột + page index, khai báo row group đã sắp theo
+    MODE_SORT_COLS[mode] và bloom filter trên user nếu có n_users (số user khác nhau của tuần)."""
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    sorting = [pq.SortingColumn(schema.get_field_index(c)) for c in MODE_SORT_COLS[mode]]
+    bloom = {'user': {'ndv': n_users, 'fpp': 0.01}} if n_users else None
+    return pq.ParquetWriter(output_file, schema, compression=compression, write_statistics=True,
+                            write_page_index=True, sorting_columns=sorting, bloom_filter_options=bloom)
+
+def write_partition(df_out, output_file, n_users=None, mode='session', chunk_size=300000):
+    # Ghi kết quả một tuần của một mode thành partition (bỏ cột week, không dòng nào thì không tạo file)
+    df_out = df_out.drop(columns=SESSION_PARTITION_COL)
+    writer = None
+    for c0 in range(0, len(df_out), chunk_size):
+        table = pa.Table.from_pandas(df_out.iloc[c0:c0 + chunk_size].reset_index(drop=True))
+        if writer is None:
+            writer = open_session_writer(output_file, table.schema, n_users, mode)
+        writer.write_table(table, row_group_size=SESSION_ROW_GROUP_SIZE)
+    if writer:
+        writer.close()
+
+def to_csv(week, mode, data, ul, uf_dict, list_uf, chunk_size=300000, incremental=False, batch=True, bloom_filter=True):
+    """Trích xuất đặc trưng một tuần cho một hoặc nhiều mode ('session', 'day', 'week'):
+    bảng số của tuần chỉ đọc và sắp xếp một lần, mọi mode dùng chung bảng này."""
+    modes = [mode] if isinstance(mode, str) else list(mode)
+    num_file = f"NumDataByWeek/{week}_num.parquet"
+    output_files = {m: session_partition_path(m, data, week) for m in modes}
+    ul = attach_frame(ul)
+    
+    # Bỏ qua tuần nếu dữ liệu số, thông tin user, code và cấu hình không đổi
+    m_inputs = {'data': file_fingerprint(num_file), 'users': frame_fingerprint(ul),
+                'uf_dict': hashlib.sha1(json.dumps(uf_dict, sort_keys=True, default=str).encode()).hexdigest()}
+    m_config = {'modes': modes, 'data': data, 'list_uf': list_uf, 'batch': batch, 'bloom_filter': bloom_filter}
+    m_key = f"{week}_{'-'.join(modes)}"
+    if incremental and stage_is_current('session', m_key, m_inputs, m_config):
+        print(f"Week {week} ({', '.join(modes)}) unchanged - skipped.")
+        return
+    # Xóa kết quả cũ (tuần không có dòng nào sẽ không tạo file mới)
+    for f in output_files.values():
+        if os.path.exists(f): os.remove(f)
+    
     # Khởi tạo từ điển ánh xạ user ID
     user_dict = {i : idx for (i, idx) in enumerate(ul.index)} 
     
@@ -962,120 +1849,513 @@ def to_csv(week, mode, data, ul, uf_dict, list_uf, chunk_size=300000):
     cols2b = ['insider']        
 
     # Đọc dữ liệu số đã xử lý của tuần hiện tại
-    w = pd.read_parquet(f"NumDataByWeek/{week}_num.parquet")
-    usnlist = list(set(w['user'].astype('int').values))
+    w = pd.read_parquet(num_file)
+    # Chỉ giữ hoạt động của user có trong danh sách nhân sự (user = -1 không được trích xuất)
+    w = w[w['user'] >= 0]
+    # Sắp xếp tuần theo user một lần (stable, giữ thứ tự thời gian): dữ liệu của mỗi user
+    # là một đoạn liên tiếp w.iloc[s0:s1], không cần quét lại cả tuần cho từng user
+    w = w.iloc[np.argsort(w['user'].values, kind='stable')].reset_index(drop=True)
+    u_ids, u_first = np.unique(w['user'].values.astype(np.int64), return_index=True)
+    u_bounds = dict(zip(u_ids.tolist(), zip(u_first.tolist(), np.r_[u_first[1:], len(w)].tolist())))
+    insider_vals = w['insider'].values
     
     # Tạo bảng thông tin User tĩnh cho tuần này
     cols_u = ['week'] + list_uf + ['ITAdmin', 'O', 'C', 'E', 'A', 'N', 'insider'] 
     uwdict = {}
     for v in user_dict:
-        if v in usnlist:
+        if v in u_bounds:
             is_ITAdmin = 1 if ul.loc[user_dict[v], 'role'] == 'ITAdmin' else 0
             # Mã hóa các thông tin category (role, dept...) thành số
             u_feats = proc_u_features(ul.loc[user_dict[v]], uf_dict, list_uf, data=data)
             # Lấy chỉ số tâm lý OCEAN
             ocean = (ul.loc[user_dict[v], ['O', 'C', 'E', 'A', 'N']]).tolist()
             # Lấy nhãn insider
-            insider_label = int(list(set(w[w['user'] == v]['insider']))[0])
+            insider_label = int(insider_vals[u_bounds[v][0]])
             
             uwdict[v] = [week] + u_feats + [is_ITAdmin] + ocean + [insider_label]
             
     uw = pd.DataFrame.from_dict(uwdict, orient='index', columns=cols_u)    
+    n_users = len(uw) if bloom_filter else None
     
-    output_file = f"tmp/{week}{mode}.parquet"
-    writer = None
-    towrite_buffer = []
-    full_columns = None
-    
-    # Duyệt qua từng User
-    for v in user_dict:
-        if v in usnlist:
-            uactw = w[w['user'] == v]
-            
-            # Get sessions
-            sessions = get_sessions(uactw, first_sid)
-            first_sid += len(sessions)
-
-            all_sess_info = list(sessions.values())
-            # Lưu ý: sinfo[4] là start_time, sinfo[5] là end_time (dạng timestamp hoặc object)
-            starts = np.array([s[4] for s in all_sess_info])
-            ends = np.array([s[5] for s in all_sess_info])
-            
-            # Tính concurrency cho từng session
-            # Logic: Session A bị coi là concurrent nếu nó trùng thời gian với bất kỳ session B nào khác (PC khác)
-            concurrent_counts = []
-            for k in range(len(all_sess_info)):
-                cur_start = starts[k]
-                cur_end = ends[k]
-                # Đếm số lượng session có khoảng thời gian giao nhau (Overlap)
-                # Điều kiện overlap: (Start_B < End_A) AND (End_B > Start_A)
-                overlaps = np.sum((starts < cur_end) & (ends > cur_start))
-                # overlaps sẽ luôn >= 1 (trùng với chính nó). 
-                concurrent_counts.append(overlaps)
-
-            # Cập nhật lại giá trị vào dict sessions
-            for idx, key in enumerate(sessions):
-                sessions[key][6] = concurrent_counts[idx] # Ghi đè vào vị trí dummy số 1 cũ
-            
-            for s in sessions:
-                sinfo = sessions[s]
-                ud = uactw.loc[sinfo[7]]
+    if 'session' in modes:
+        writer = None
+        towrite_buffer = []
+        full_columns = None
+    
+        # Gán session cho toàn bộ tuần một lần (sessions đã sắp theo user rồi theo sessionid)
+        sessions, sid = get_sessions(w, first_sid)
+        w['sessionid'] = sid
+        # Các dòng của session thứ k nằm ở row_order[row_start[k]:row_start[k+1]]
+        row_order = np.argsort(sid, kind='stable')
+        row_start = np.r_[0, np.cumsum(sessions['n_acts'].values)]
+        sess_user = sessions['user'].values.astype(np.int64)
+    
+        # Tính concurrency cho mọi session của tuần cùng lúc
+        # Logic: Session A bị coi là concurrent nếu nó trùng thời gian với bất kỳ session B nào khác (PC khác)
+        n_concurrent = count_concurrent_sessions(sess_user, sessions['start_ts'].values, sessions['end_ts'].values)
+    
+        if batch:
+            # Tính đặc trưng của mọi session trong một lượt group-by trên cả tuần
+            df_out = session_instance_batch(w, sessions, sid - first_sid, n_concurrent, week, uw, list_uf)
+            write_partition(df_out, output_files['session'], n_users, 'session', chunk_size)
+            del df_out
+        else:
+            # Duyệt qua từng User (tính từng session bằng f_calc)
+            for v in user_dict:
+                if v in u_bounds:
+                    s0, s1 = np.searchsorted(sess_user, [v, v + 1])
+                    for k in range(s0, s1):
+                        srow = sessions.iloc[k]
+                        # sinfo giữ định dạng cũ: [sessionid, pc, start_with, end_with, start_ts, end_ts, n_concurrent]
+                        sinfo = [srow['sessionid'], srow['pcid'], srow['start_with'], srow['end_with'],
+                                 srow['start_ts'], srow['end_ts'], n_concurrent[k]]
+                        ud = w.iloc[row_order[row_start[k]:row_start[k + 1]]]
                 
-                if len(ud) > 0:                     
-                    # Tính feature
-                    session_instance, i_fnames = session_instance_calc(
-                        ud, sinfo, week, mode, data, uw, v, list_uf
-                    )
+                        if len(ud) > 0:                     
+                            # Tính feature
+                            session_instance, i_fnames = session_instance_calc(
+                                ud, sinfo, week, 'session', data, uw, v, list_uf
+                            )
                     
-                    # Nếu là lần đầu tiên, xác định danh sách cột đầy đủ
-                    if writer is None:
-                         full_columns = cols2a + i_fnames + cols2b
+                            # Nếu là lần đầu tiên, xác định danh sách cột đầy đủ
+                            if writer is None:
+                                 full_columns = cols2a + i_fnames + cols2b
                     
-                    towrite_buffer.append(session_instance)
+                            towrite_buffer.append(session_instance)
                     
-                    # --- FLUSH BUFFER NẾU ĐẦY ---
-                    if len(towrite_buffer) >= chunk_size:
-                        df_chunk = pd.DataFrame(towrite_buffer, columns=full_columns)
+                            # --- FLUSH BUFFER NẾU ĐẦY ---
+                            if len(towrite_buffer) >= chunk_size:
+                                df_chunk = pd.DataFrame(towrite_buffer, columns=full_columns).drop(columns=SESSION_PARTITION_COL)
                         
-                        # Convert sang Table và ghi
-                        table = pa.Table.from_pandas(df_chunk)
+                                # Convert sang Table và ghi
+                                table = pa.Table.from_pandas(df_chunk)
                         
-                        if writer is None:
-                            writer = pq.ParquetWriter(output_file, table.schema, compression='snappy')
+                                if writer is None:
+                                    writer = open_session_writer(output_files['session'], table.schema, n_users)
                         
-                        writer.write_table(table)
+                                writer.write_table(table, row_group_size=SESSION_ROW_GROUP_SIZE)
                         
-                        # Dọn dẹp RAM
-                        del df_chunk, table
-                        towrite_buffer = [] # Reset buffer
-                        gc.collect()
-
-    # --- GHI PHẦN CÒN DƯ (Buffer còn lại) ---
-    if len(towrite_buffer) > 0:
-        try:
-            df_chunk = pd.DataFrame(towrite_buffer, columns=full_columns)
-            table = pa.Table.from_pandas(df_chunk)
+                                # Dọn dẹp RAM
+                                del df_chunk, table
+                                towrite_buffer = [] # Reset buffer
+                                gc.collect()
+
+        # --- GHI PHẦN CÒN DƯ (Buffer còn lại) ---
+        if len(towrite_buffer) > 0:
+            try:
+                df_chunk = pd.DataFrame(towrite_buffer, columns=full_columns).drop(columns=SESSION_PARTITION_COL)
+                table = pa.Table.from_pandas(df_chunk)
             
-            if writer is None:
-                writer = pq.ParquetWriter(output_file, table.schema, compression='snappy')
+                if writer is None:
+                    writer = open_session_writer(output_files['session'], table.schema, n_users)
             
-            writer.write_table(table)
-        except UnboundLocalError:
-            # Trường hợp không có session nào được tạo ra
-            pass
+                writer.write_table(table, row_group_size=SESSION_ROW_GROUP_SIZE)
+            except UnboundLocalError:
+                # Trường hợp không có session nào được tạo ra
+                pass
 
-    if writer:
-        writer.close()
+        if writer:
+            writer.close()
+
+    # Đặc trưng theo user-ngày / user-tuần: group-by trên cùng bảng w, không đọc lại dữ liệu
+    for m in modes:
+        if m != 'session':
+            write_partition(period_instance_batch(w, m, week, uw, list_uf), output_files[m], n_users, m, chunk_size)
+    write_stage_record('session', m_key, m_inputs, m_config, list(output_files.values()))
     
     # Xóa biến lớn để giải phóng RAM cho joblib process khác
     del w, uw
     gc.collect()
 
+def merge_week_sessions(week_files, output_file, compression='snappy'):
+    """Gộp các partition {tuần: file} của một mode thành một file duy nhất (tùy chọn, cho code cũ đọc một file):
+    đọc từng row group và ghi thẳng bằng Arrow, thêm lại cột week ở vị trí cũ (ngay sau 'day', mode 'week': sau 'user').
+    Schema chung được tính trước từ mọi tuần (int -> float được phép); cột lệch hoặc kiểu không
+    tương thích thì báo lỗi ngay thay vì bỏ qua tuần. Khi các tuần cùng kiểu, schema giống file gộp cũ
+    (kể cả các cột thông tin user, xem user_feature_columns); khác duy nhất: file cũ ép mọi tuần về kiểu
+    của tuần đầu, ở đây cột int của một tuần được nâng lên float nếu tuần khác là float."""
+    if not week_files: return
+    files = list(week_files.values())
+    schemas = [pq.read_schema(f) for f in files]
+    names = schemas[0].names
+    for (f, sc) in zip(files, schemas):
+        if set(sc.names) != set(names):
+            raise ValueError(f"Schema drift in {f}: columns {sorted(set(sc.names) ^ set(names))} do not match {files[0]}")
+    schema = pa.unify_schemas([sc.remove_metadata() for sc in schemas], promote_options='permissive')
+    week_pos = schema.get_field_index('day' if 'day' in names else 'user') + 1
+    schema = schema.insert(week_pos, pa.field(SESSION_PARTITION_COL, pa.int64()))
+    
+    # Ghi ra file tạm rồi đổi tên: file kết quả không bao giờ ở trạng thái dở dang
+    with pq.ParquetWriter(output_file + ".tmp", schema, compression=compression) as writer:
+        for (week, f) in week_files.items():
+            pf = pq.ParquetFile(f)
+            for rg in range(pf.num_row_groups):
+                t = pf.read_row_group(rg).select(names)
+                t = t.add_column(week_pos, SESSION_PARTITION_COL, pa.array(np.full(t.num_rows, week, dtype=np.int64)))
+                writer.write_table(t.cast(schema))
+    os.replace(output_file + ".tmp", output_file)
+
+# --- SLIDING-WINDOW BASELINE ---
+BASELINE_DIR = "Baseline"
+# Baseline của mỗi user là `BASELINE_WINDOW` tuần liền trước (không gồm tuần đang xét)
+BASELINE_WINDOW = 4
+BASELINE_FEATURES = ['email_mean_n_exdes', 'http_n_cloudf', 'isafterhour']
+
+def baseline_state_path(mode, data, week):
+    return f"{BASELINE_DIR}/{mode}_{data}/state_{week}.npz"
+
+def load_baseline_state(path, n_users, n_feat, window):
+    # Trạng thái sau một tuần: đóng góp (số dòng, tổng, tổng bình phương) của từng user trong
+    # `window` tuần gần nhất (mảng vòng, tuần k ở ô k % window) và tổng chạy của cả cửa sổ
+    if path is None or not os.path.exists(path):
+        return {'hist_n': np.zeros((window, n_users)), 'hist_s': np.zeros((window, n_users, n_feat)),
+                'hist_q': np.zeros((window, n_users, n_feat)), 'sum_n': np.zeros(n_users),
+                'sum_s': np.zeros((n_users, n_feat)), 'sum_q': np.zeros((n_users, n_feat))}
+    with np.load(path) as st:
+        return {k: st[k] for k in st.files}
+
+def baseline_week(week, state, mode, data, features):
+    """Tính đặc trưng lệch baseline cho các dòng của một tuần rồi trượt cửa sổ sang tuần này.
+    Chỉ đọc file của tuần đang xét; cập nhật trạng thái tốn O(số user), không tính lại các tuần cũ."""
+    in_file = session_partition_path(mode, data, week)
+    keys = MODE_SORT_COLS[mode]
+    if os.path.exists(in_file):
+        df = pd.read_parquet(in_file, columns=keys + features)
+    else:
+        df = pd.DataFrame({c: np.zeros(0, dtype=np.int64) for c in keys + features})
+    u = df['user'].values.astype(np.int64)
+    x = df[features].to_numpy(dtype=np.float64)
+    
+    # Baseline (trung bình, độ lệch chuẩn) của user từ các tuần trước, tra theo vị trí user
+    n_prev = state['sum_n'][u][:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = state['sum_s'][u] / n_prev
+        var = state['sum_q'][u] / n_prev - mean ** 2
+    # Sai số làm tròn của tổng chạy: phương sai quá nhỏ so với trung bình coi như bằng 0
+    var[var < 1e-12 * (mean ** 2 + 1)] = 0
+    std = np.sqrt(var)
+    dev = np.zeros_like(x)
+    np.divide(x - mean, std, out=dev, where=std > 0)
+    # Chưa có lịch sử: baseline và độ lệch để trống (NaN)
+    dev[np.broadcast_to(n_prev == 0, dev.shape)] = np.nan
+    
+    out = {c: df[c].values for c in keys}
+    out[SESSION_PARTITION_COL] = np.full(len(df), week)
+    for (j, f) in enumerate(features):
+        out[f + '_base_mean'] = mean[:, j]
+        out[f + '_base_std'] = std[:, j]
+        out[f + '_dev'] = dev[:, j]
+    
+    # Trượt cửa sổ: bỏ đóng góp của tuần week - window (cùng ô), thêm đóng góp của tuần này
+    slot = week % len(state['hist_n'])
+    n_users = len(state['sum_n'])
+    c_n = np.bincount(u, minlength=n_users).astype(np.float64)
+    c_s = np.stack([np.bincount(u, weights=x[:, j], minlength=n_users) for j in range(len(features))], axis=1)
+    c_q = np.stack([np.bincount(u, weights=x[:, j] ** 2, minlength=n_users) for j in range(len(features))], axis=1)
+    for (h, s, c) in [('hist_n', 'sum_n', c_n), ('hist_s', 'sum_s', c_s), ('hist_q', 'sum_q', c_q)]:
+        state[s] += c - state[h][slot]
+        state[h][slot] = c
+    return pd.DataFrame(out)
+
+def update_baselines(n_weeks, n_users, mode='session', data='r4.2', features=BASELINE_FEATURES, window=BASELINE_WINDOW, incremental=False):
+    """Đặc trưng baseline theo cửa sổ trượt cho kết quả của to_csv, duyệt các tuần theo thứ tự.
+    Mỗi tuần ghi ExtractedData/{mode}_baseline_{data}/week=N (cùng thứ tự dòng và khóa với
+    partition của mode, ghép cột trực tiếp) và lưu trạng thái sau tuần đó để lần chạy sau tiếp tục."""
+    config = {'mode': mode, 'data': data, 'features': features, 'window': window, 'n_users': n_users}
+    os.makedirs(os.path.dirname(baseline_state_path(mode, data, 0)), exist_ok=True)
+    state = None
+    for week in range(n_weeks):
+        prev_file = baseline_state_path(mode, data, week - 1) if week > 0 else None
+        state_file = baseline_state_path(mode, data, week)
+        output_file = session_partition_path(f"{mode}_baseline", data, week)
+        # Tuần phụ thuộc dữ liệu của chính nó và trạng thái sau tuần trước (thay đổi lan sang các tuần sau)
+        m_inputs = {'data': file_fingerprint(session_partition_path(mode, data, week)),
+                    'state': file_fingerprint(prev_file) if prev_file else None}
+        m_key = f"{mode}_{week}"
+        if incremental and stage_is_current('baseline', m_key, m_inputs, config):
+            state = None
+            continue
+        if state is None:
+            state = load_baseline_state(prev_file, n_users, len(features), window)
+        
+        if os.path.exists(output_file): os.remove(output_file)
+        write_partition(baseline_week(week, state, mode, data, features), output_file, mode=mode)
+        with open(state_file + '.tmp', 'wb') as f:
+            np.savez(f, **state)
+        os.replace(state_file + '.tmp', state_file)
+        write_stage_record('baseline', m_key, m_inputs, config, [output_file, state_file])
+
+# --- STREAMING (ONLINE) ---
+# Số sự kiện tối đa mỗi lô xử lý của chế độ online và thời gian chờ (giây) trước khi xử lý lô chưa đầy
+STREAM_BATCH_ROWS = 20000
+STREAM_POLL_TIMEOUT = 0.5
+# Session không có hoạt động mới quá khoảng này (pd.Timedelta) được xuất sớm với end_with=3; None = tắt,
+# session chỉ đóng bằng Logoff/Logon mới hoặc khi hết luồng (như bước 4)
+STREAM_IDLE_TIMEOUT = None
+
+def parse_event_lines(data):
+    # Các dòng CSV (theo DATA_COLUMNS, ngày dạng r4.2) -> bảng Arrow theo DATA_SCHEMA như DataByWeek
+    read_opts = pcsv.ReadOptions(column_names=DATA_COLUMNS)
+    conv_opts = pcsv.ConvertOptions(column_types={c: pa.string() for c in DATA_COLUMNS}, strings_can_be_null=True)
+    table = pcsv.read_csv(pa.BufferReader(data), read_options=read_opts, convert_options=conv_opts)
+    dates = pac.strptime(table.column('date'), format='%m/%d/%Y %H:%M:%S', unit='ns')
+    return to_storage_table(table.set_column(DATA_COLUMNS.index('date'), 'date', dates))
+
+def iter_event_source(source, batch_rows=STREAM_BATCH_ROWS, poll_timeout=STREAM_POLL_TIMEOUT):
+    """Đọc sự kiện từ file CSV hoặc socket 'host:port' (dòng đầu là header DATA_COLUMNS) và trả về
+    từng lô bảng Arrow. Với socket, lô chưa đầy vẫn được trả về khi quá poll_timeout giây không có dữ liệu mới."""
+    if os.path.exists(source):
+        f = open(source, 'rb')
+        read = f.read
+    else:
+        (host, port) = source.rsplit(':', 1)
+        f = socket.create_connection((host, int(port)))
+        f.settimeout(poll_timeout)
+        read = f.recv
+    buf = b''
+    header = None
+    pending = []
+    try:
+        while True:
+            try:
+                data = read(1 << 20)
+            except socket.timeout:
+                data = None
+            if data == b'': break
+            if data:
+                buf += data
+                cut = buf.rfind(b'\n') + 1
+                (complete, buf) = (buf[:cut], buf[cut:])
+                if header is None and cut > 0:
+                    (header, complete) = complete.split(b'\n', 1)
+                    if [c.strip('"') for c in header.decode().strip().split(',')] != DATA_COLUMNS:
+                        raise ValueError(f"{source}: header {header!r} does not match DATA_COLUMNS")
+                if complete:
+                    pending += complete.split(b'\n')[:-1]
+            while len(pending) >= batch_rows:
+                yield parse_event_lines(b'\n'.join(pending[:batch_rows]) + b'\n')
+                pending = pending[batch_rows:]
+            if data is None and pending:
+                yield parse_event_lines(b'\n'.join(pending) + b'\n')
+                pending = []
+        if buf.strip(): pending.append(buf)
+        if pending: yield parse_event_lines(b'\n'.join(pending) + b'\n')
+    finally:
+        f.close()
+
+def replay_events(out, weeks, first_header=True):
+    """Phát lại các tuần DataByWeek (nguồn CSV CERT đã gộp theo tuần) theo thứ tự thời gian thành luồng
+    CSV theo DATA_COLUMNS (ngày dạng r4.2) vào file nhị phân out (file hoặc socket.makefile('wb'))."""
+    header = first_header
+    for week in weeks:
+        file_path = f"DataByWeek/{week}.parquet"
+        if not os.path.exists(file_path): continue
+        # File tuần chỉ gộp các nguồn theo khối, sự kiện phát đi phải theo đúng thứ tự thời gian
+        week_table = pq.read_table(file_path).sort_by('date')
+        for table in week_table.to_batches(max_chunksize=STREAM_BATCH_ROWS):
+            cols = [pac.strftime(table['date'].cast(pa.timestamp('s')), format='%m/%d/%Y %H:%M:%S') if c == 'date'
+                    else table[c].cast(pa.string()) for c in DATA_COLUMNS]
+            pcsv.write_csv(pa.Table.from_arrays(cols, names=DATA_COLUMNS), out,
+                           pcsv.WriteOptions(include_header=header, quoting_style='needed'))
+            header = False
+    out.flush()
+
+def stream_sessions(batches, users, data='r4.2', catalog=None, mal_index=None, firstdate=None, idle_timeout=STREAM_IDLE_TIMEOUT):
+    """Featurize online: nhận từng lô sự kiện (bảng Arrow theo DATA_SCHEMA, theo thứ tự thời gian),
+    giữ các dòng số của session đang mở theo (user, PC) trong RAM và sau mỗi lô trả về DataFrame các session
+    vừa đóng (Logoff hoặc Logon mới trên cùng PC), cùng cột với bước 4 mode 'session'; hết luồng thì xuất
+    nốt các session còn mở (end_with=0). Nếu đặt idle_timeout, session không có hoạt động mới quá khoảng đó
+    được xuất sớm với end_with=3 (khác với session thật sự còn mở, end_with=0).
+    Session chứa USB Connect chưa có Disconnect được giữ lại đến khi có Disconnect (hoặc hết luồng) để
+    usb_dur giống bước 4. Dùng lại num_features_batch, get_sessions, count_concurrent_sessions và
+    session_instance_batch. Session mở qua ranh giới tuần không bị cắt; n_concurrent_sessions chỉ tính
+    các session đã biết khi đóng. PC chưa có trong catalog được cấp mã mới khi xuất hiện (cột pc coi là
+    PC khác); sự kiện của user không có trong catalog bị bỏ qua vì thiếu thông tin LDAP."""
+    if catalog is None: catalog = load_id_catalog(data)
+    if firstdate is None: firstdate = get_first_date()
+    if mal_index is None:
+        if os.path.exists(answer_key_path(data)):
+            mal_index = get_mal_act_index(open_answer_key(data))
+        else:
+            mal_index = pd.MultiIndex.from_arrays([[], []], names=['user', 'id'])
+    user_dict = catalog_codes(catalog, 'user')
+    pc_dict = catalog_codes(catalog, 'pc')
+    (ul, uf_dict, list_uf) = get_u_features_dicts(users.copy(), data=data, catalog=catalog)
+    
+    # Thông tin user tĩnh (như uw của to_csv) cho mọi user, theo mã user
+    uw = pd.DataFrame({f: ul[f].map(uf_dict[f]).values for f in list_uf})
+    uw['ITAdmin'] = (ul['role'].values == 'ITAdmin').astype(int)
+    for c in ['O', 'C', 'E', 'A', 'N']:
+        uw[c] = ul[c].values
+    
+    first_ns = np.datetime64(firstdate, 'ns').astype(np.int64)
+    week_ns = 7 * 24 * 3600 * 10**9
+    num_names = {'date': 'time_stamp', 'user_int': 'user', 'act_num': 'act', 'pc_code': 'pc'}
+    offset = 0
+    next_sid = 0
+    # Dòng số của các session đang mở, dòng USB Connect chưa có cặp, các session đã đóng còn có thể giao nhau,
+    # session đã đóng đang chờ Disconnect (dòng kèm vị trí spos và bảng session kèm n_concurrent)
+    open_w = None
+    usb_open = None
+    closed = pd.DataFrame({'user': np.zeros(0, dtype=np.int64), 'start_ts': np.zeros(0, dtype='datetime64[ns]'),
+                           'end_ts': np.zeros(0, dtype='datetime64[ns]')})
+    wait_w = None
+    wait_s = None
+    
+    def emit(w, flush):
+        nonlocal next_sid, closed, wait_w, wait_s
+        (w_done, s_done) = ([], []) if wait_s is None else ([wait_w], [wait_s])
+        if w is not None and len(w):
+            w = w.sort_values('time_stamp', kind='stable').reset_index(drop=True)
+            (sessions, sid) = get_sessions(w)
+            now = w['time_stamp'].values.max()
+            ended = sessions['end_with'].values != 0
+            idle = np.zeros(len(sessions), dtype=bool)
+            if idle_timeout is not None and not flush:
+                idle = ~ended & (sessions['end_ts'].values < now - pd.Timedelta(idle_timeout).to_timedelta64())
+            done = ended | idle | flush
+            
+            # Concurrency: trên các session đã đóng gần đây + mọi session của lô (đang mở thì tính đến hiện tại)
+            all_user = np.r_[closed['user'].values, sessions['user'].values.astype(np.int64)]
+            all_st = np.r_[closed['start_ts'].values, sessions['start_ts'].values]
+            all_end = np.r_[closed['end_ts'].values, sessions['end_ts'].values]
+            n_concurrent = count_concurrent_sessions(all_user, all_st, all_end)[len(closed):][done]
+            
+            rows = done[sid]
+            s_new = sessions[done].reset_index(drop=True)
+            s_new.loc[idle[done], 'end_with'] = 3
+            s_new['n_concurrent'] = n_concurrent
+            n_wait = sum(len(s) for s in s_done)
+            w_done.append(w[rows].assign(spos=n_wait + (np.cumsum(done) - 1)[sid[rows]]))
+            s_done.append(s_new)
+            
+            # Giữ lại session đã đóng chỉ khi còn giao được với một session đang mở của cùng user (session mới
+            # của các lô sau bắt đầu không sớm hơn mọi end_ts đã thấy nên không giao được)
+            closed = pd.concat([closed, s_new[['user', 'start_ts', 'end_ts']].astype({'user': np.int64})], ignore_index=True)
+            open_s = sessions[~done]
+            open_start = pd.Series(open_s['start_ts'].values).groupby(open_s['user'].values.astype(np.int64)).min()
+            closed = closed[closed['end_ts'].values > open_start.reindex(closed['user'].values).values].reset_index(drop=True)
+            w = w[~rows].reset_index(drop=True)
+        if not s_done:
+            return w, pd.DataFrame()
+        w_done = pd.concat(w_done, ignore_index=True)
+        s_done = pd.concat(s_done, ignore_index=True)
+        spos = w_done['spos'].values
+        
+        # Session có Connect chưa có cặp: chờ Disconnect ở lô sau (hoặc hết luồng) để usb_dur giống bước 4.
+        # Session giữ nguyên ranh giới đã xác định, chỉ cập nhật usb_dur
+        wait = np.zeros(len(s_done), dtype=bool)
+        if not flush and usb_open is not None:
+            wait[spos[w_done['actid'].isin(usb_open.index).values]] = True
+        rows = wait[spos]
+        (wait_w, wait_s) = (None, None)
+        if wait.any():
+            wait_w = w_done[rows].assign(spos=(np.cumsum(wait) - 1)[spos[rows]])
+            wait_w.index = wait_w['actid'].values
+            wait_s = s_done[wait].reset_index(drop=True)
+        
+        s_out = s_done[~wait].reset_index(drop=True)
+        s_out['sessionid'] = next_sid + np.arange(len(s_out))
+        next_sid += len(s_out)
+        out = session_instance_batch(w_done[~rows].reset_index(drop=True), s_out, (np.cumsum(~wait) - 1)[spos[~rows]],
+                                     s_out['n_concurrent'].values, 0, uw, list_uf)
+        out['week'] = (s_out['start_ts'].values.astype(np.int64) - first_ns) // week_ns
+        return w, out
+    
+    for table in batches:
+        n = table.num_rows
+        acts = week_table_to_frame(table.select(BASE_COLUMNS), pd.RangeIndex(offset, offset + n))
+        offset += n
+        # PC chưa có trong catalog (máy mới trên luồng): cấp mã tiếp theo, tránh gộp mọi PC lạ vào pcid -1
+        for pc in acts['pc'].cat.categories:
+            if pc not in pc_dict: pc_dict[pc] = len(pc_dict)
+        (df_num, df_usb) = num_features_batch(acts, table, users, user_dict, pc_dict, mal_index)
+        df_num['actid'] = df_num.index
+        df_num = df_num.rename(columns=num_names)
+        df_num = df_num[df_num['user'] >= 0]
+        
+        # USB Duration: ghép cả các Connect còn chờ từ lô trước, cập nhật lại dòng đang mở và dòng đang chờ
+        df_usb = df_usb if usb_open is None else pd.concat([usb_open, df_usb])
+        usb_dur = usb_durations(df_usb)
+        last = df_usb.groupby(['user', 'pc'], sort=False).tail(1)
+        usb_open = last[last['activity'] == 'Connect']
+        w = df_num if open_w is None else pd.concat([open_w, df_num])
+        w.index = w['actid'].values
+        for f in [w] if wait_w is None else [w, wait_w]:
+            upd = usb_dur.index[usb_dur.index.isin(f.index)]
+            f.loc[upd, 'usb_dur'] = usb_dur.loc[upd].values.astype(int)
+        
+        (open_w, out) = emit(w, False)
+        yield out
+    (_, out) = emit(open_w, True)
+    yield out
+
+def benchmark_streaming(weeks, users, data='r4.2', catalog=None, firstdate=None, batch_rows=STREAM_BATCH_ROWS, port=0):
+    """Đo thông lượng (sự kiện/giây) và độ trễ xử lý mỗi lô (từ khi lô đến tới khi có session đã đóng)
+    của stream_sessions khi phát lại DataByWeek qua file CSV cục bộ và qua socket localhost."""
+    if firstdate is None: firstdate = get_first_date()
+    stream_file = f"{CATALOG_DIR}/stream_{data}.csv"
+    with open(stream_file, 'wb') as f:
+        replay_events(f, weeks)
+    
+    server = socket.create_server(('127.0.0.1', port))
+    def serve():
+        (conn, _) = server.accept()
+        with conn, conn.makefile('wb') as out:
+            replay_events(out, weeks)
+    
+    results = {}
+    for kind in ['file', 'socket']:
+        if kind == 'socket':
+            threading.Thread(target=serve, daemon=True).start()
+            source = f"127.0.0.1:{server.getsockname()[1]}"
+        else:
+            source = stream_file
+        arrivals = []
+        def timed(src):
+            for table in src:
+                arrivals.append((time.perf_counter(), table.num_rows))
+                yield table
+        latency, n_sessions = [], 0
+        st = time.perf_counter()
+        for out in stream_sessions(timed(iter_event_source(source, batch_rows)), users, data, catalog, firstdate=firstdate):
+            n_sessions += len(out)
+            if len(latency) < len(arrivals):
+                latency.append(time.perf_counter() - arrivals[-1][0])
+        elapsed = time.perf_counter() - st
+        n_events = sum(n for (_, n) in arrivals)
+        results[kind] = {'events': n_events, 'sessions': n_sessions, 'seconds': elapsed,
+                         'events_per_sec': n_events / elapsed if elapsed > 0 else 0.0,
+                         'latency_ms_p50': 1000 * float(np.percentile(latency, 50)) if latency else 0.0,
+                         'latency_ms_p99': 1000 * float(np.percentile(latency, 99)) if latency else 0.0}
+        print(f"Streaming ({kind}): {results[kind]}")
+    server.close()
+    os.remove(stream_file)
+    return results
+
+# Các hàm quyết định kết quả của từng stage (đổi code của hàm nào thì stage đó chạy lại)
+STAGE_CODE = {
+    'ingest': [time_convert, get_first_date, to_storage_table, combine_by_timerange_pandas,
+               iter_act_week_batches, write_week_chunks, combine_by_timerange_arrow,
+               get_source_ranges, split_source_by_week, merge_week_fragments, combine_by_timerange_parallel],
+    'num': [catalog_codes, vectorized_is_after_whour, vectorized_is_weekend, content_stats, vectorized_email_process,
+            HTTP_DOMAIN_LISTS, classify_hosts, lookup_http_domains, vectorized_http_process, vectorized_file_process, vectorized_from_pc,
+            map_categorical, get_mal_act_index, NUM_FEATURE_COLS, BASE_COLUMNS, TEXT_COLUMNS,
+            week_table_to_frame, iter_week_frames, load_week_text, num_features_batch,
+            num_batch_table, usb_durations, NUM_SCHEMA, process_week_num],
+    'session': [get_sessions, count_concurrent_sessions, proc_u_features, f_stats_calc, f_calc_subfeatures, f_calc,
+                session_instance_calc, SESSION_FEATURE_SPEC, f_stats_batch, f_calc_batch, user_feature_columns,
+                MODE_TIME_GROUPS, MODE_PC_COUNTS, mode_feature_groups, session_instance_batch, period_instance_batch,
+                SESSION_PARTITION_COL, SESSION_ROW_GROUP_SIZE, MODE_SORT_COLS, open_session_writer, write_partition, to_csv],
+    'merge': [merge_week_sessions],
+    'baseline': [load_baseline_state, baseline_week, update_baselines],
+}
+
 if __name__ == "__main__":
     # 1. Kiểm tra thư mục hiện tại có phải là r4.2 không
     dname = 'r4.2'
     # 2. Tạo các thư mục tạm và thư mục chứa kết quả
-    for folder in ["tmp", "ExtractedData", "DataByWeek", "NumDataByWeek"]:
+    for folder in ["ExtractedData", "DataByWeek", "NumDataByWeek", MANIFEST_DIR, HTTP_DOMAIN_CACHE_DIR, CATALOG_DIR, BASELINE_DIR]:
         if not os.path.exists(folder):
             os.mkdir(folder)
     
@@ -1091,66 +2371,108 @@ if __name__ == "__main__":
         
     # r4.2 có 73 tuần dữ liệu
     numWeek = 73 
+    # Engine đọc csv ở bước 1: 'parallel' (mỗi nguồn/đoạn byte một process),
+    # 'arrow' (đọc theo block, đa luồng, một process) hoặc 'pandas' (đọc từng dòng)
+    ingest_engine = 'parallel'
+    # Chạy tăng dần: chỉ chạy lại các tuần có đầu vào/code thay đổi (theo Manifest), giữ lại file trung gian
+    incremental = True
+    # Ngân sách RAM (byte) mỗi worker ở bước 3: số dòng mỗi lô được tính theo ngân sách này
+    # (None = đọc cả tuần một lần; đặt vd 4 << 30 khi RAM mỗi worker hạn chế)
+    num_memory_budget = None
+    # Bước 4 ghi dataset chia partition theo tuần; bật để gộp thêm mỗi mode một file duy nhất (vd session_r4.2.parquet)
+    merge_single_file = False
+    # Chế độ online: nguồn sự kiện (file csv theo DATA_COLUMNS hoặc 'host:port'), None = không chạy;
+    # số tuần DataByWeek phát lại để đo thông lượng / độ trễ của chế độ online (0 = không chạy)
+    stream_source = None
+    stream_benchmark_weeks = 0
     st = time.time()
     
     #### Bước 1: Phân tách dữ liệu nguồn theo từng tuần
-    combine_by_timerange_pandas(dname)
+    ingest_inputs = {act: file_fingerprint(os.path.join(BASE_PATH, act + '.csv'), content=False) for act in ALL_ACTS}
+    ingest_config = {'schema': str(DATA_SCHEMA), 'compression': WEEK_COMPRESSION, 'row_group_size': WEEK_ROW_GROUP_SIZE}
+    if incremental and stage_is_current('ingest', dname, ingest_inputs, ingest_config):
+        print("Step 1 - Source data unchanged - skipped.")
+    else:
+        # Xóa các file tuần cũ để không sót tuần thừa từ lần chạy trước
+        for f in os.listdir("DataByWeek"):
+            if f.endswith(".parquet"): os.remove(os.path.join("DataByWeek", f))
+        if ingest_engine == 'parallel':
+            combine_by_timerange_parallel(dname, n_jobs=numCores)
+        elif ingest_engine == 'arrow':
+            combine_by_timerange_arrow(dname)
+        else:
+            combine_by_timerange_pandas(dname)
+        week_files = sorted(os.path.join("DataByWeek", f) for f in os.listdir("DataByWeek") if f.endswith(".parquet"))
+        write_stage_record('ingest', dname, ingest_inputs, ingest_config, week_files)
     print(f"Step 1 - Separate data by week - done. Time (mins): {(time.time()-st)/60:.2f}")
     st = time.time()
     
     #### Bước 2: Lấy danh sách nhân sự và dán nhãn Insider
     users = get_mal_userdata(dname)
+    # Bảng mã số nguyên cho user/PC/thuộc tính user, dùng chung cho mọi bước sau
+    catalog = build_id_catalog(users, dname)
     print(f"Step 2 - Get user list & Insider labels - done. Time (mins): {(time.time()-st)/60:.2f}")
     st = time.time()
     
     #### Bước 3: Chuyển đổi log thô sang dạng số (Numerical)
-    Parallel(n_jobs=numCores)(delayed(process_week_num)(i, users, data=dname) for i in range(numWeek))
+    # Bảng users và đáp án insider: mỗi worker tự mmap file (không truyền qua pickle cho từng task)
+    users_ref = broadcast_frame(users, 'users', dname)
+    Parallel(n_jobs=numCores)(delayed(process_week_num)(i, users_ref, data=dname, incremental=incremental, catalog=catalog, memory_budget=num_memory_budget) for i in range(numWeek))
+    # Gộp các host HTTP mới mà từng worker đã phân loại vào bảng chung cho lần chạy sau
+    merge_http_domain_cache()
     print(f"Step 3 - Numerical conversion - done. Time (mins): {(time.time()-st)/60:.2f}")
     st = time.time()
     
-    #### Bước 4: Trích xuất đặc trưng theo SESSION và xuất ra CSV
-    mode = 'session'
-    (ul, uf_dict, list_uf) = get_u_features_dicts(users, data=dname)
+    #### Bước 4: Trích xuất đặc trưng theo SESSION, user-ngày, user-tuần và xuất ra Parquet
+    modes = ['session', 'day', 'week']
+    (ul, uf_dict, list_uf) = get_u_features_dicts(users, data=dname, catalog=catalog)
+    ul_ref = broadcast_frame(ul, 'ul', dname)
+    
+    # Chạy song song: mỗi tuần đọc bảng số một lần và tính đặc trưng cho mọi mode
+    Parallel(n_jobs=numCores)(delayed(to_csv)(i, modes, dname, ul_ref, uf_dict, list_uf, incremental=incremental) for i in range(numWeek))
+
+    for mode in modes:
+        # Mỗi tuần đã được ghi thẳng thành một partition, đọc lại bằng vd:
+        # pd.read_parquet(dataset_dir, filters=[('week', '>=', 10), ('insider', '>', 0)])
+        dataset_dir = f'ExtractedData/{mode}_{dname}'
+        output_file = dataset_dir
+        if merge_single_file:
+            output_file = f'{dataset_dir}.parquet'
+            partitions = {w: session_partition_path(mode, dname, w) for w in range(numWeek)}
+            merge_inputs = {f: file_fingerprint(f) for f in partitions.values()}
+            merge_config = {'mode': mode}
+            if incremental and stage_is_current('merge', mode, merge_inputs, merge_config):
+                print(f"{output_file} is up to date - skipped merge.")
+            else:
+                print(f"Starting to merge files into {output_file}...")
+                week_files = {w: f for (w, f) in partitions.items() if os.path.exists(f)}
+                merge_week_sessions(week_files, output_file)
+                write_stage_record('merge', mode, merge_inputs, merge_config, [output_file])
+        print(f'Step 4 - Extracted {mode} data to {output_file}.')
+    print(f'Step 4 - Feature extraction - done. Time (mins): {(time.time()-st)/60:.2f}')
+    st = time.time()
     
-    # Chạy song song việc gom nhóm session và tính toán đặc trưng thống kê
-    Parallel(n_jobs=numCores)(delayed(to_csv)(i, mode, dname, ul, uf_dict, list_uf) for i in range(numWeek))
-
-    # Gộp tất cả các file pickle tạm thời trong 'tmp/' thành một file CSV duy nhất
-    output_file = f'ExtractedData/{mode}_{dname}.parquet'
-    print(f"Starting to merge files into {output_file}...")
-    writer = None
-    ref_schema = None
-    for w in range(numWeek):
-        week_file = f"tmp/{w}{mode}.parquet"
-        if os.path.exists(week_file):
-            # Đọc file pickle tuần hiện tại
-            df_chunk = pd.read_parquet(week_file)
-            
+    #### Bước 5: Baseline theo cửa sổ trượt của từng user (chỉ cập nhật các tuần mới hoặc thay đổi)
+    update_baselines(numWeek, len(ul), 'session', dname, incremental=incremental)
+    print(f"Step 5 - Sliding-window baselines - done. Time (mins): {(time.time()-st)/60:.2f}")
+    
+    #### Chế độ online (tùy chọn): featurize sự kiện khi chúng đến, ghi session ngay khi đóng
+    if stream_source is not None:
+        stream_file = f'ExtractedData/stream_session_{dname}.parquet'
+        writer = None
+        for out in stream_sessions(iter_event_source(stream_source), users, dname, catalog):
+            if len(out) == 0: continue
+            table = pa.Table.from_pandas(out, preserve_index=False)
             if writer is None:
-                # Đây là chunk đầu tiên (thường là tuần 0 hoặc 1) -> Làm chuẩn
-                table = pa.Table.from_pandas(df_chunk)
-                writer = pq.ParquetWriter(output_file, table.schema, compression='snappy')
-                writer.write_table(table)
-                # Lưu lại kiểu dữ liệu của pandas để ép các chunk sau
-                ref_dtypes = df_chunk.dtypes
-            else:
-                try:
-                    df_chunk = df_chunk.astype(ref_dtypes)
-                except Exception as e:
-                    print(f"Warning: Could not cast types for week {w}. Reason: {e}")
-                
-                table = pa.Table.from_pandas(df_chunk)
-                try: 
-                    writer.write_table(table)
-                except Exception as e:
-                    print(f"Error writing week {w}: {e}")
-        else: pass
-    # Đóng writer để hoàn tất file
-    if writer:
-        writer.close()
-    print(f'Step 4 - Extracted {mode} data to {output_file}. Time (mins): {(time.time()-st)/60:.2f}')
-
-    #### Bước 5: Dọn dẹp thư mục tạm
-    print("Cleaning up temporary files...")
-    for x in ["tmp", "DataByWeek", "NumDataByWeek"]:
-        if os.path.exists(x): shutil.rmtree(x)
\ No newline at end of file
+                writer = pq.ParquetWriter(stream_file, table.schema, compression='snappy')
+            writer.write_table(table.cast(writer.schema))
+        if writer: writer.close()
+        print(f"Online sessions from {stream_source} written to {stream_file}.")
+    if stream_benchmark_weeks > 0:
+        benchmark_streaming(range(stream_benchmark_weeks), users, dname, catalog)
+
+    #### Bước 6: Dọn dẹp thư mục tạm (chế độ incremental giữ lại để lần chạy sau dùng tiếp)
+    if not incremental:
+        print("Cleaning up temporary files...")
+        for x in ["DataByWeek", "NumDataByWeek", MANIFEST_DIR, BASELINE_DIR]:
+            if os.path.exists(x): shutil.rmtree(x)
\ No newline at end of file